@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+Helpers shared by the benchmarks: synthetic galleries to measure against.
+"""
+
+import os
+import os.path
+import sys
+
+from PIL import Image
+
+# Run against the working tree rather than an installed copy.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+def make_photo(path, size, seed=0, quality=90):
+    """
+    Write a JPEG of the given size with enough detail to be costly to
+    decode and resample.
+    """
+    (width, height) = size
+    img = Image.effect_mandelbrot(size,
+            (-2.0 + (seed * 0.01), -1.3, 1.0, 1.3), 100).convert('RGB')
+    img.save(path, 'JPEG', quality=quality)
+    return path
+
+
+def make_gallery(root, photos, size, gallery='bench'):
+    """
+    Create a gallery root holding one gallery of the given number of
+    photos, named p00.jpg onwards, with an empty cache directory.
+    """
+    gallery_dir = os.path.join(root, gallery)
+    os.makedirs(gallery_dir, exist_ok=True)
+    os.makedirs(os.path.join(root, 'cache'), exist_ok=True)
+    with open(os.path.join(gallery_dir, 'info.txt'), 'w') as info:
+        info.write('.title\tBenchmark\n.desc\tSynthetic photos\n')
+
+    names = []
+    for index in range(photos):
+        name = 'p%02d.jpg' % index
+        make_photo(os.path.join(gallery_dir, name), size, index)
+        names.append(name)
+    return names
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Measure the fast downscale path (JPEG draft decoding and reducing before
+resampling) against a full decode: time per rendition, and how far the
+results differ.
+
+    python benchmarks/fast_downscale.py [--size 6000x4000] [--repeat 5]
+"""
+
+import argparse
+import os.path
+import shutil
+import tempfile
+import time
+
+from common import make_photo
+
+from PIL import Image, ImageChops, ImageStat
+
+from tornado_gallery.resizer import resize_photo, \
+        DEFAULT_FAST_DOWNSCALE_RATIO
+
+
+def run(src, work_dir, width, height, fast_ratio, repeat):
+    start = time.time()
+    for index in range(repeat):
+        path = resize_photo(src, work_dir,
+                '%dx%d-%s-%d.jpg' % (width, height, fast_ratio, index),
+                width, height, 60.0, 0.0, 'image/jpeg', 1, fast_ratio)
+    elapsed = (time.time() - start) / repeat
+    with Image.open(path) as result:
+        return (elapsed, result.convert('RGB'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', default='6000x4000')
+    parser.add_argument('--rendition', action='append',
+            help='WIDTHxHEIGHT; may be repeated (default 100x67, 720x480)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        src = make_photo(os.path.join(work_dir, 'src.jpg'),
+                tuple(int(n) for n in args.size.split('x')))
+        for rendition in (args.rendition or ['100x67', '720x480']):
+            (width, height) = (int(n) for n in rendition.split('x'))
+            (full, full_img) = run(src, work_dir, width, height, None,
+                    args.repeat)
+            (fast, fast_img) = run(src, work_dir, width, height,
+                    DEFAULT_FAST_DOWNSCALE_RATIO, args.repeat)
+            diff = ImageStat.Stat(
+                    ImageChops.difference(full_img, fast_img)).mean
+            print('%s: full %.3fs/img, fast %.3fs/img (x%.1f), '
+                    'mean abs diff %.2f' % (rendition, full, fast,
+                        full / fast, max(diff)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
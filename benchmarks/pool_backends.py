@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Compare the thread and process back-ends of the resizer pool: how many
+renditions of large JPEGs each renders per second with all workers busy.
+
+    python benchmarks/pool_backends.py [--photos 24] [--size 4000x3000]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import make_gallery
+
+from cachefs import CacheFs
+from tornado.gen import coroutine, multi
+from tornado.ioloop import IOLoop
+
+from tornado_gallery.pool import BACKENDS
+from tornado_gallery.resizer import ResizerPool
+
+
+@coroutine
+def run(root, names, backend, workers, width, height, fast_ratio):
+    shutil.rmtree(os.path.join(root, 'cache'))
+    os.makedirs(os.path.join(root, 'cache'))
+
+    # The pool only holds a weak reference to the file system cache.
+    fs_cache = CacheFs(300, 1)
+    resizer = ResizerPool(fs_cache[root], 'cache', num_proc=workers,
+            pool_backend=backend, fast_downscale_ratio=fast_ratio)
+    start = time.time()
+    yield multi([resizer.get_resized('bench', name, width, height,
+        quality=60) for name in names])
+    elapsed = time.time() - start
+    print('%-8s %d renditions in %.2fs: %.1f/s' % (backend, len(names),
+        elapsed, len(names) / elapsed))
+    resizer._pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--photos', type=int, default=24)
+    parser.add_argument('--size', default='4000x3000')
+    parser.add_argument('--rendition', default='720x540')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--fast-downscale-ratio', type=float, default=0.0,
+            help='Downscale ratio for draft decoding; 0 (the default) '
+                'decodes in full, as the comparison was first made')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        size = tuple(int(n) for n in args.size.split('x'))
+        (width, height) = (int(n) for n in args.rendition.split('x'))
+        names = make_gallery(root, args.photos, size)
+        print('%d workers, %d cores' % (args.workers, os.cpu_count()))
+        for backend in BACKENDS:
+            IOLoop.current().run_sync(lambda : run(root, names, backend,
+                args.workers, width, height, args.fast_downscale_ratio))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
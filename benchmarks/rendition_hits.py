@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Measure the cost of requesting a rendition that is already cached, in
+memory and on disk, and count how many times each request opens the
+original (with Pillow or libmagic) to get there.
+
+    python benchmarks/rendition_hits.py [--requests 2000]
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from common import make_gallery
+
+import magic
+from PIL import Image
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from tornado_gallery.gallery import GalleryCollection
+
+# Calls counted whilst measuring
+counts = {'Image.open': 0, 'magic.Magic': 0}
+
+
+def _counted(name, func):
+    def wrapper(*args, **kwargs):
+        counts[name] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@coroutine
+def run(root, requests, width, height):
+    collection = GalleryCollection(root, num_proc=1, pool_backend='thread')
+    gallery = collection['bench']
+    yield gallery.load_properties()
+    photo = gallery['p00.jpg']
+
+    # Get it into both caches first.
+    yield photo.get_resized(width=width, height=height)
+
+    Image.open = _counted('Image.open', Image.open)
+    magic.Magic = _counted('magic.Magic', magic.Magic)
+
+    def measure(label, request):
+        for name in counts:
+            counts[name] = 0
+        start = time.perf_counter()
+        for index in range(requests):
+            yield request()
+        elapsed = time.perf_counter() - start
+        print('%-18s %7.1f us/request, per request: %s' % (label,
+            elapsed / requests * 1e6, ', '.join('%s %.2f' % (name,
+                count / requests) for (name, count) in counts.items())))
+
+    yield from measure('memory cache hit',
+            lambda : photo.get_resized(width=width, height=height))
+    yield from measure('disk cache hit',
+            lambda : photo.get_rendition_path(
+                photo.get_rendition(width=width, height=height)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--size', default='3000x2000')
+    parser.add_argument('--rendition', default='720x540')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        make_gallery(root, 1, tuple(int(n) for n in args.size.split('x')))
+        (width, height) = (int(n) for n in args.rendition.split('x'))
+        IOLoop.current().run_sync(lambda : run(root, args.requests,
+            width, height))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import unittest
+
+from tornado_gallery.ladder import SizeLadder, uri_form
+
+
+class SizeLadderTests(unittest.TestCase):
+    """
+    Tests for snapping rendition parameters onto the ladder.
+    """
+
+    def test_snap_is_idempotent(self):
+        ladder = SizeLadder(sizes=[100, 200, 400], qualities=[25, 60, 85],
+                rotation_step=0.1)
+        for rotation in (0.0, 0.3, 0.7, 12.34, 90.05, 359.96):
+            for (width, height, quality) in ((150, 150, 60.0),
+                    (None, 90, 30.0), (500, None, 99.0)):
+                once = ladder.snap(width, height, quality, rotation)
+                twice = ladder.snap(*once)
+                self.assertEqual(uri_form(*once), uri_form(*twice))
+
+    def test_snapped_rotation_survives_uri(self):
+        ladder = SizeLadder(rotation_step=0.1)
+        rotation = ladder.snap_rotation(0.3)
+        # As the rotation would be read back from its URI
+        self.assertEqual(rotation, float('%f' % rotation))
+        self.assertEqual(ladder.snap_rotation(rotation), rotation)
+
+    def test_rotation_wraps(self):
+        ladder = SizeLadder(rotation_step=90)
+        self.assertEqual(ladder.snap_rotation(350.0), 0.0)
+        self.assertEqual(ladder.snap_rotation(-90.0), 270.0)
+
+    def test_unconfigured_passes_through(self):
+        ladder = SizeLadder()
+        self.assertEqual(ladder.snap(123, None, 42.0, 1.5),
+                (123, None, 42.0, 1.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import unittest
+
+from concurrent.futures.process import BrokenProcessPool
+from tornado.gen import coroutine, sleep
+from tornado.ioloop import IOLoop
+
+from tornado_gallery.pool import WorkerPool, BACKEND_PROCESS, \
+        BACKEND_THREAD, PRIORITY_INTERACTIVE, JobCancelled
+
+
+class WorkerPoolTests(unittest.TestCase):
+    """
+    Tests for the worker pool's handling of failed and cancelled jobs.
+    """
+
+    def setUp(self):
+        self._io_loop = IOLoop()
+        self._io_loop.make_current()
+        self.addCleanup(self._io_loop.close)
+        self.addCleanup(IOLoop.clear_current)
+
+    def test_worker_death(self):
+        pool = WorkerPool(1, backend=BACKEND_PROCESS, reserve={},
+                memory_budget=1000)
+        self.addCleanup(pool.close)
+
+        @coroutine
+        def run():
+            with self.assertRaises(BrokenProcessPool):
+                yield pool.apply(os._exit, (1,), cost=500)
+
+            # The slot and memory are given back, and the pool still works.
+            self.assertEqual(pool.stats['interactive']['running'], 0)
+            self.assertEqual(pool.memory_stats['used'], 0)
+            result = yield pool.apply(pow, (2, 3))
+            self.assertEqual(result, 8)
+
+        self._io_loop.run_sync(run, timeout=30)
+
+    def test_cancelled_jobs_leave_load(self):
+        pool = WorkerPool(1, backend=BACKEND_THREAD, reserve={})
+        self.addCleanup(pool.close)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        cancelled = set()
+
+        @coroutine
+        def run():
+            # Occupy the only worker, then queue jobs behind it.
+            blocker = pool.apply(release.wait)
+            queued = [pool.apply(pow, (2, n),
+                        is_cancelled=lambda n=n : n in cancelled)
+                    for n in range(3)]
+            yield sleep(0.01)
+            self.assertEqual(pool.get_load(PRIORITY_INTERACTIVE)[0], 3)
+
+            # Cancel the jobs behind the head of the queue.
+            cancelled.update((1, 2))
+            self.assertEqual(pool.get_load(PRIORITY_INTERACTIVE)[0], 1)
+            for future in queued[1:]:
+                with self.assertRaises(JobCancelled):
+                    yield future
+
+            release.set()
+            yield blocker
+            result = yield queued[0]
+            self.assertEqual(result, 1)
+
+        self._io_loop.run_sync(run, timeout=30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from tornado_gallery.properties import PropertiesIndex
+
+
+class PropertiesIndexTests(unittest.TestCase):
+    """
+    Tests for saving the properties index.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'index.json')
+        self.stat = os.stat(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_clears_dirty(self):
+        index = PropertiesIndex(self.path)
+        index.set('a.jpg', self.stat, {'width': 1})
+        self.assertTrue(index.dirty)
+        index.save()
+        self.assertFalse(index.dirty)
+        with open(self.path) as index_file:
+            self.assertIn('a.jpg', json.load(index_file)['photos'])
+
+    def test_set_during_save_stays_dirty(self):
+        index = PropertiesIndex(self.path)
+        index.set('a.jpg', self.stat, {'width': 1})
+
+        # Simulate another thread setting an entry whilst the index is
+        # being written out.
+        dump = json.dump
+        def set_whilst_writing(obj, fp):
+            index.set('b.jpg', self.stat, {'width': 2})
+            dump(obj, fp)
+        json.dump = set_whilst_writing
+        try:
+            index.save()
+        finally:
+            json.dump = dump
+
+        self.assertTrue(index.dirty)
+        index.save()
+        self.assertFalse(index.dirty)
+        other = PropertiesIndex(self.path)
+        self.assertEqual(other.get('b.jpg', self.stat), {'width': 2})
+
+    def test_merges_other_writers(self):
+        first = PropertiesIndex(self.path)
+        second = PropertiesIndex(self.path)
+        first.set('a.jpg', self.stat, {'width': 1})
+        second.set('b.jpg', self.stat, {'width': 2})
+        first.save()
+        second.save()
+        with open(self.path) as index_file:
+            self.assertEqual(sorted(json.load(index_file)['photos']),
+                    ['a.jpg', 'b.jpg'])
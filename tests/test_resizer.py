@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import logging
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+from tornado_gallery.resizer import ImageFormat, _resize_photo, \
+        calc_dimensions, oriented_dimensions, rotated_dimensions
+
+# Largest mean difference (out of 255) allowed from the old pipeline.  The
+# old pipeline rotated with nearest-neighbour sampling, so the edges of
+# rotated images differ a little; a wrong orientation differs by over 30.
+TOLERANCE = 3.0
+
+# Angles to rotate by, in degrees
+ANGLES = (0.0, 90.0, 180.0, 270.0, 12.5, 30.0, 45.0, 135.0, -60.0)
+
+
+def _old_resize(img, width, height, rotation, orientation):
+    """
+    The pipeline resize_photo() used to run: apply the EXIF orientation,
+    rotate at full size, then resize.
+    """
+    if orientation == 2:
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 3:
+        img = img.transpose(Image.ROTATE_180)
+    elif orientation == 4:
+        img = img.transpose(Image.ROTATE_180).transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 5:
+        img = img.transpose(Image.ROTATE_270).transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 6:
+        img = img.transpose(Image.ROTATE_270)
+    elif orientation == 7:
+        img = img.transpose(Image.ROTATE_90).transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 8:
+        img = img.transpose(Image.ROTATE_90)
+
+    if rotation != 0:
+        img = img.rotate(rotation, expand=1)
+
+    return img.resize((width, height), Image.LANCZOS).convert('RGB')
+
+
+class ResizePipelineTests(unittest.TestCase):
+    """
+    Check the shrink-first pipeline in _resize_photo() against the old
+    orient, rotate then resize pipeline.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._dir)
+
+        # An asymmetric test card, so that a wrong orientation shows.
+        self._src = Image.new('RGB', (480, 320))
+        draw = ImageDraw.Draw(self._src)
+        for x in range(0, 480, 4):
+            draw.rectangle([x, 0, x + 3, 319],
+                    fill=(x * 255 // 480, 128, 255 - (x * 255 // 480)))
+        draw.rectangle([20, 20, 180, 120], fill=(255, 255, 0))
+        draw.ellipse([300, 180, 460, 300], fill=(0, 0, 255))
+        self._src_path = os.path.join(self._dir, 'card.png')
+        self._src.save(self._src_path)
+
+    def _resize(self, width, height, rotation, orientation,
+            fast_ratio=None):
+        cache_path = os.path.join(self._dir, 'out.png')
+        _resize_photo(self._src_path, cache_path, width, height, 60.0,
+                rotation, ImageFormat.PNG, orientation, fast_ratio,
+                logging.getLogger(__name__))
+        with Image.open(cache_path) as result:
+            return result.convert('RGB')
+
+    def _check(self, box, fast_ratio=None):
+        for orientation in range(1, 9):
+            for rotation in ANGLES:
+                (width, height) = calc_dimensions(*(rotated_dimensions(
+                    *(oriented_dimensions(*(self._src.size
+                        + (orientation,))) + (rotation,))) + box))
+                (width, height) = (max(int(width), 1), max(int(height), 1))
+                with self.subTest(orientation=orientation,
+                        rotation=rotation, box=box):
+                    result = self._resize(width, height, rotation,
+                            orientation, fast_ratio)
+                    expected = _old_resize(self._src, width, height,
+                            rotation, orientation)
+                    self.assertEqual(result.size, expected.size)
+                    diff = ImageStat.Stat(
+                            ImageChops.difference(result, expected)).mean
+                    self.assertLess(sum(diff) / len(diff), TOLERANCE)
+
+    def test_shrink(self):
+        self._check((120, 120))
+
+    def test_shrink_fast(self):
+        self._check((120, 120), fast_ratio=2.0)
+
+    def test_enlarge(self):
+        self._check((720, 720))
+
+
+class TransparencyTests(unittest.TestCase):
+    """
+    Check that transparency survives into GIF and PNG renditions.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._dir)
+
+        # A transparent card with an opaque square in the middle.
+        card = Image.new('RGBA', (400, 200), (255, 0, 0, 0))
+        card.paste((0, 0, 255, 255), (100, 50, 300, 150))
+        self._png = os.path.join(self._dir, 'card.png')
+        card.save(self._png)
+        self._gif = os.path.join(self._dir, 'card.gif')
+        card.save(self._gif)
+
+    def _check(self, src, img_format, rotation):
+        (width, height) = rotated_dimensions(200, 100, rotation)
+        (width, height) = (int(width), int(height))
+        out = os.path.join(self._dir, 'out.%s' % img_format.ext)
+        _resize_photo(src, out, width, height, 60, rotation, img_format,
+                0, None, logging.getLogger(__name__))
+        with Image.open(out) as img:
+            img = img.convert('RGBA')
+            (centre_x, centre_y) = (img.size[0] // 2, img.size[1] // 2)
+            self.assertEqual(img.getpixel((1, 1))[3], 0)
+            self.assertEqual(img.getpixel((centre_x, centre_y)),
+                    (0, 0, 255, 255))
+
+    def test_formats(self):
+        for src in (self._png, self._gif):
+            for img_format in (ImageFormat.GIF, ImageFormat.PNG):
+                for rotation in (0.0, 30.0):
+                    with self.subTest(src=os.path.basename(src),
+                            img_format=img_format.name, rotation=rotation):
+                        self._check(src, img_format, rotation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from tornado_gallery.pool import BACKEND_THREAD
+from tornado_gallery.server import GalleryApp, DEFAULT_PAGE_SIZE, \
+        MAX_PAGE_SIZE
+
+# Photos in the test gallery; more than the most that may be listed at once
+GALLERY_SIZE = 2500
+
+STATIC_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tornado_gallery', 'static')
+
+
+class GalleryMetaTests(unittest.TestCase):
+    """
+    Check that gallery metadata is only ever listed a page at a time.
+    """
+
+    def setUp(self):
+        self._io_loop = IOLoop()
+        self._io_loop.make_current()
+        self.addCleanup(self._io_loop.close, all_fds=True)
+        self.addCleanup(IOLoop.clear_current)
+
+        self._dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._dir)
+
+        # Listing a gallery doesn't open the photos, so empty files do.
+        gallery_dir = os.path.join(self._dir, 'big')
+        os.makedirs(gallery_dir)
+        os.makedirs(os.path.join(self._dir, 'cache'))
+        with open(os.path.join(gallery_dir, 'info.txt'), 'w') as info:
+            info.write('.title\tBig\n.desc\tA large gallery\n')
+        for n in range(GALLERY_SIZE):
+            open(os.path.join(gallery_dir, 'p%05d.jpg' % n), 'w').close()
+
+        app = GalleryApp(root_dir=self._dir, static_uri='/static/',
+                static_path=STATIC_PATH, template_path=STATIC_PATH,
+                site_name='Test', site_uri='', num_proc=1,
+                pool_backend=BACKEND_THREAD)
+        (sock, port) = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        self.addCleanup(server.stop)
+        self._base_uri = 'http://127.0.0.1:%d' % port
+
+    def _get_meta(self, query=''):
+        response = self._io_loop.run_sync(lambda : AsyncHTTPClient().fetch(
+            self._base_uri + '/meta/big' + query, raise_error=False))
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body.decode('UTF-8'))
+
+    def test_default_page(self):
+        meta = self._get_meta()
+        self.assertEqual(meta['total'], GALLERY_SIZE)
+        self.assertEqual(len(meta['content']), DEFAULT_PAGE_SIZE)
+        self.assertEqual(meta['content'][0], 'p00000.jpg')
+
+    def test_limit_bounded(self):
+        meta = self._get_meta('?offset=100&limit=%d' % GALLERY_SIZE)
+        self.assertEqual(len(meta['content']), MAX_PAGE_SIZE)
+        self.assertEqual(meta['content'][0], 'p00100.jpg')
+        meta = self._get_meta('?limit=0')
+        self.assertEqual(len(meta['content']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import logging
+from time import time
+
+# Responses given to refused requests
+STATUS_OVERLOADED = 503
+STATUS_THROTTLED = 429
+
+# Forget idle clients once we are tracking this many
+MAX_CLIENTS = 10000
+
+
+class AdmissionController(object):
+    """
+    Decides whether a request that needs a rendition rendered may join the
+    worker pool's queue.  Requests are refused when the queue is deeper, or
+    the estimated wait longer, than the limits given; and a client may only
+    cause misses at a sustained rate, with a burst allowance, enforced by a
+    token bucket per client.  Any of the limits may be omitted.
+    """
+
+    def __init__(self, max_queue=None, max_wait=None, client_rate=None,
+            client_burst=None, log=None):
+        if log is None:
+            log = logging.getLogger(self.__class__.__module__)
+
+        self._log = log
+        self._max_queue = max_queue
+        self._max_wait = max_wait
+        self._client_rate = client_rate
+        self._client_burst = float(client_burst or max(client_rate or 0, 1))
+        self._buckets = {}
+
+        self._admitted = 0
+        self._overloaded = 0
+        self._throttled = 0
+        self._fallbacks = 0
+
+    def admit(self, client, queued, wait):
+        """
+        Decide whether a client may queue a rendering, given the number of
+        jobs ahead of it and the estimated wait in seconds.  Returns None if
+        so, otherwise the HTTP status to refuse with and how many seconds to
+        ask the client to wait.
+        """
+        if ((self._max_queue is not None) and (queued >= self._max_queue)) \
+                or ((self._max_wait is not None) and (wait > self._max_wait)):
+            self._overloaded += 1
+            self._log.debug('Refusing %s: %d queued, %.1f sec wait',
+                    client, queued, wait)
+            return (STATUS_OVERLOADED, max(wait, 1.0))
+
+        retry_after = self._take_token(client)
+        if retry_after is not None:
+            self._throttled += 1
+            self._log.debug('Throttling %s for %.1f sec',
+                    client, retry_after)
+            return (STATUS_THROTTLED, retry_after)
+
+        self._admitted += 1
+        return None
+
+    def _take_token(self, client):
+        """
+        Take a token from the client's bucket, returning None if there was
+        one or else how long until there will be.
+        """
+        if not self._client_rate:
+            return None
+
+        now = time()
+        try:
+            (tokens, updated) = self._buckets[client]
+            tokens = min(self._client_burst,
+                    tokens + ((now - updated) * self._client_rate))
+        except KeyError:
+            if len(self._buckets) >= MAX_CLIENTS:
+                self._prune(now)
+            tokens = self._client_burst
+
+        if tokens < 1.0:
+            self._buckets[client] = (tokens, now)
+            return (1.0 - tokens) / self._client_rate
+
+        self._buckets[client] = (tokens - 1.0, now)
+        return None
+
+    def _prune(self, now):
+        """
+        Forget clients whose buckets have refilled.
+        """
+        refill = self._client_burst / self._client_rate
+        for (client, (tokens, updated)) in list(self._buckets.items()):
+            if (now - updated) >= refill:
+                self._buckets.pop(client)
+
+    def note_fallback(self):
+        """
+        Record that a refused request was given a fallback rendition.
+        """
+        self._fallbacks += 1
+
+    @property
+    def stats(self):
+        return {
+                'admitted': self._admitted,
+                'overloaded': self._overloaded,
+                'throttled': self._throttled,
+                'fallbacks': self._fallbacks,
+                'clients': len(self._buckets),
+        }
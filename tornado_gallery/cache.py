@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from time import time
-from collections import Mapping
+from collections import Mapping, OrderedDict
 import logging
 
 
@@ -58,3 +58,85 @@ class Cache(Mapping):
         if len(expiries):
             return min(expiries)
         return None
+
+
+class LRUCache(object):
+    """
+    A least-recently-used cache of byte strings, bounded by their total
+    size.  Each entry is stored with a tag (such as the modification time of
+    the file it was derived from) and is only returned when asked for with
+    the same tag.
+    """
+
+    def __init__(self, max_size, log=None):
+        if log is None:
+            log = logging.getLogger(self.__class__.__module__)
+
+        self._log = log
+        self._max_size = int(max_size)
+        self._items = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, tag):
+        """
+        Retrieve the data stored for the given key and tag, or None.
+        """
+        try:
+            (item_tag, data) = self._items[key]
+        except KeyError:
+            self._misses += 1
+            return None
+
+        if item_tag != tag:
+            # Out of date
+            self._log.debug('Discarding stale %s', key)
+            self._discard(key)
+            self._misses += 1
+            return None
+
+        self._items.move_to_end(key)
+        self._hits += 1
+        return data
+
+    def put(self, key, tag, data):
+        """
+        Store the data for the given key and tag, evicting the least
+        recently used entries to make room.
+        """
+        if len(data) > self._max_size:
+            # Would not fit
+            return
+
+        self._discard(key)
+        self._items[key] = (tag, data)
+        self._size += len(data)
+
+        while self._size > self._max_size:
+            (old_key, (_, old_data)) = self._items.popitem(last=False)
+            self._size -= len(old_data)
+            self._evictions += 1
+            self._log.debug('Evicted %s', old_key)
+
+    def _discard(self, key):
+        try:
+            (_, data) = self._items.pop(key)
+            self._size -= len(data)
+        except KeyError:
+            pass
+
+    @property
+    def stats(self):
+        """
+        Return the cache statistics.
+        """
+        return {
+                'entries': len(self._items),
+                'size': self._size,
+                'max_size': self._max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+        }
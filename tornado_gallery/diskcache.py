@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import os.path
+import sqlite3
+from time import time
+
+INDEX_FILE = '.index.sqlite'
+
+# When trimming, go this far below the budget so we're not trimming again
+# straight away.
+TRIM_LOW_WATER = 0.9
+
+# Renditions still being written after this long (seconds) were abandoned
+STALE_TEMP_AGE = 3600.0
+
+
+class CacheManager(object):
+    """
+    Keeps track of when the renditions in the cache directory were last
+    used, and removes the least recently used ones when the cache exceeds
+    its size or file count budget.  Accesses are collected in memory and
+    written to an SQLite index in the cache directory in batches.
+
+    The index is opened by the first thread to write to it; all later
+    writes must come from that thread.
+    """
+
+    def __init__(self, cache_dir, max_size=None, max_files=None, log=None):
+        if log is None:
+            log = logging.getLogger(self.__class__.__module__)
+
+        self._log = log
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._max_files = max_files
+        self._pending = {}
+        self._db = None
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def max_files(self):
+        return self._max_files
+
+    @property
+    def _conn(self):
+        if self._db is None:
+            self._db = open_index(self._cache_dir)
+        return self._db
+
+    def touch(self, cache_path, size):
+        """
+        Record an access of the given cache file.
+        """
+        rel_path = os.path.relpath(cache_path, self._cache_dir)
+        try:
+            (_, hits, _) = self._pending[rel_path]
+        except KeyError:
+            hits = 0
+        self._pending[rel_path] = (time(), hits + 1, size)
+
+    def take_pending(self):
+        """
+        Return the accesses recorded since this was last called, to be
+        written out with record().
+        """
+        (pending, self._pending) = (self._pending, {})
+        return pending
+
+    def flush(self):
+        """
+        Write out the accesses recorded since the last flush.
+        """
+        self.record(self.take_pending())
+
+    def record(self, pending):
+        """
+        Write out the accesses given by take_pending().  This may wait on
+        another process's trim, so should be run away from the IOLoop.
+        """
+        if not pending:
+            return
+
+        with self._conn as conn:
+            conn.executemany('INSERT OR IGNORE INTO renditions '\
+                    '(path, size, atime, hits) VALUES (?, ?, ?, 0)',
+                    [(path, size, atime)
+                        for (path, (atime, _, size)) in pending.items()])
+            conn.executemany('UPDATE renditions SET '\
+                    'atime=MAX(atime, ?), hits=hits+?, size=? '\
+                    'WHERE path=?',
+                    [(atime, hits, size, path)
+                        for (path, (atime, hits, size)) in pending.items()])
+        self._log.debug('Recorded %d accesses', len(pending))
+
+    @property
+    def stats(self):
+        return {
+                'pending': len(self._pending),
+                'max_size': self._max_size,
+                'max_files': self._max_files,
+        }
+
+
+def open_index(cache_dir):
+    """
+    Open the access index for the given cache directory, creating it if
+    needed.
+    """
+    conn = sqlite3.connect(os.path.join(cache_dir, INDEX_FILE), timeout=30.0)
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS renditions ('\
+                'path TEXT PRIMARY KEY, size INTEGER NOT NULL, '\
+                'atime REAL NOT NULL, hits INTEGER NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS renditions_atime '\
+                'ON renditions (atime)')
+    return conn
+
+
+def _remove_stale(path, stale, log):
+    """
+    Remove a temporary file if it was last written before the given time.
+    """
+    try:
+        if os.stat(path).st_mtime < stale:
+            os.unlink(path)
+            log.info('Removed abandoned file %s', path)
+    except OSError:
+        pass
+
+
+def scan_cache(cache_dir, log=None):
+    """
+    Bring the access index in line with what is on disk: add files that are
+    not indexed (as last used when written) and drop entries for files that
+    have gone.  Partly written renditions left behind by workers that died
+    are removed.  Returns the number of files added and dropped.
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    on_disk = {}
+    stale = time() - STALE_TEMP_AGE
+    for (dir_path, dir_names, file_names) in os.walk(cache_dir):
+        for name in file_names:
+            if name.startswith('.'):
+                # Indexes, temporary files, etc.
+                if name.endswith('.tmp'):
+                    _remove_stale(os.path.join(dir_path, name), stale, log)
+                continue
+            path = os.path.join(dir_path, name)
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            on_disk[os.path.relpath(path, cache_dir)] = file_stat
+
+    conn = open_index(cache_dir)
+    try:
+        indexed = set(row[0] for row in
+                conn.execute('SELECT path FROM renditions'))
+        added = [(path, file_stat.st_size, file_stat.st_mtime)
+                for (path, file_stat) in on_disk.items()
+                if path not in indexed]
+        dropped = [(path,) for path in indexed if path not in on_disk]
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO renditions '\
+                    '(path, size, atime, hits) VALUES (?, ?, ?, 0)', added)
+            conn.executemany('DELETE FROM renditions WHERE path=?', dropped)
+    finally:
+        conn.close()
+
+    log.info('Scanned %s: %d files added, %d dropped',
+            cache_dir, len(added), len(dropped))
+    return (len(added), len(dropped))
+
+
+def get_usage(cache_dir):
+    """
+    Return the total size and number of files in the cache, per the index.
+    """
+    conn = open_index(cache_dir)
+    try:
+        (size, files) = conn.execute(
+                'SELECT SUM(size), COUNT(*) FROM renditions').fetchone()
+    finally:
+        conn.close()
+    return (size or 0, files)
+
+
+def trim_cache(cache_dir, max_size=None, max_files=None, log=None):
+    """
+    Remove the least recently used renditions until the cache is within the
+    budget given.  Returns the number of files and bytes removed.  This does
+    file I/O, so is intended to be run in a worker.
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    (size, files) = get_usage(cache_dir)
+    over_size = (max_size is not None) and (size > max_size)
+    over_files = (max_files is not None) and (files > max_files)
+    if not (over_size or over_files):
+        return (0, 0)
+
+    target_size = int(max_size * TRIM_LOW_WATER) \
+            if max_size is not None else size
+    target_files = int(max_files * TRIM_LOW_WATER) \
+            if max_files is not None else files
+
+    removed_files = 0
+    removed_size = 0
+    conn = open_index(cache_dir)
+    try:
+        victims = conn.execute('SELECT path, size FROM renditions '\
+                'ORDER BY atime ASC').fetchall()
+        removed = []
+        for (path, file_size) in victims:
+            if (size <= target_size) and (files <= target_files):
+                break
+
+            abs_path = os.path.join(cache_dir, path)
+            try:
+                os.unlink(abs_path)
+                removed_files += 1
+                removed_size += file_size
+            except OSError:
+                # Already gone?
+                pass
+            removed.append((path,))
+            size -= file_size
+            files -= 1
+
+            # The photo's directory is left in place even if now empty, as a
+            # worker may be about to write into it.
+
+        with conn:
+            conn.executemany('DELETE FROM renditions WHERE path=?', removed)
+    finally:
+        conn.close()
+
+    log.info('Trimmed %d files (%d bytes) from %s',
+            removed_files, removed_size, cache_dir)
+    return (removed_files, removed_size)
+
+
+def main(*args, **kwargs):
+    """
+    Report on, or trim, the cache directory whilst the server is offline.
+    """
+    parser = argparse.ArgumentParser(prog='tornado-gallery cache',
+            description='Tornado Photo Gallery cache maintenance')
+    parser.add_argument('action', choices=('report', 'trim'),
+            help='Report cache usage, or trim the cache to the budget')
+    parser.add_argument('--log-level', dest='log_level',
+            default='INFO', help='Logging level')
+    parser.add_argument('--root-dir', dest='root_dir', type=str,
+            required=True, help='Root directory containing photo galleries')
+    parser.add_argument('--cache-subdir', dest='cache_subdir', type=str,
+            default='cache', help='Cache directory within the root')
+    parser.add_argument('--cache-max-size', dest='cache_max_size', type=int,
+            default=None, help='Cache size budget (MiB)')
+    parser.add_argument('--cache-max-files', dest='cache_max_files',
+            type=int, default=None, help='Cache file count budget')
+
+    args = parser.parse_args(*args, **kwargs)
+
+    logging.basicConfig(level=args.log_level,
+            format='%(asctime)s %(levelname)10s '\
+                    '%(name)16s %(process)d/%(threadName)s: %(message)s')
+
+    cache_dir = os.path.join(args.root_dir, args.cache_subdir)
+    scan_cache(cache_dir)
+
+    if args.action == 'trim':
+        max_size = args.cache_max_size * 1024 * 1024 \
+                if args.cache_max_size is not None else None
+        trim_cache(cache_dir, max_size, args.cache_max_files)
+
+    (size, files) = get_usage(cache_dir)
+    print('%s: %d files, %.1f MiB' % (cache_dir, files,
+        size / (1024.0 * 1024.0)))
@@ -11,8 +11,10 @@ from time import time
 
 from .metadata import MetadataCache
 from .cache import Cache
-from .photo import Photo
-from .resizer import ResizerPool
+from .photo import Photo, THUMB_SIZE, THUMB_QUALITY
+from .resizer import ResizerPool, DEFAULT_FAST_DOWNSCALE_RATIO, \
+        DEFAULT_MEMORY_CACHE_SIZE
+from .pool import BACKEND_PROCESS, DEFAULT_AGING, PRIORITY_INTERACTIVE
 
 from tornado.gen import coroutine, Return
 
@@ -26,8 +28,15 @@ class GalleryCollection(Cache):
     """
 
     def __init__(self, root_dir, cache_subdir=CACHE_DIR_NAME,
-            num_proc=None, cache_expiry=300.0,
-            cache_stat_expiry=1.0, log=None):
+            num_proc=None, pool_backend=BACKEND_PROCESS, pool_reserve=None,
+            pool_aging=DEFAULT_AGING, memory_budget=None,
+            fast_downscale_ratio=DEFAULT_FAST_DOWNSCALE_RATIO,
+            derive_renditions=False, rendition_pyramid=False,
+            memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE,
+            cache_max_size=None, cache_max_files=None, cache_trim=True,
+            cache_index=False, thumb_size=THUMB_SIZE,
+            thumb_quality=THUMB_QUALITY,
+            cache_expiry=300.0, cache_stat_expiry=1.0, log=None):
         if log is None:
             log = logging.getLogger(self.__class__.__module__)
 
@@ -39,8 +48,20 @@ class GalleryCollection(Cache):
         self._root_node = self._fs_cache[root_dir]
         self._resizer_pool = ResizerPool(
                 self._root_node, cache_subdir=cache_subdir,
-                num_proc=num_proc, log=log.getChild('resizer'))
+                num_proc=num_proc, pool_backend=pool_backend,
+                pool_reserve=pool_reserve, pool_aging=pool_aging,
+                memory_budget=memory_budget,
+                fast_downscale_ratio=fast_downscale_ratio,
+                derive=derive_renditions, pyramid=rendition_pyramid,
+                memory_cache_size=memory_cache_size,
+                cache_max_size=cache_max_size,
+                cache_max_files=cache_max_files,
+                cache_trim=cache_trim,
+                cache_index=cache_index,
+                log=log.getChild('resizer'))
         self._cache_subdir = cache_subdir
+        self._thumb_size = thumb_size
+        self._thumb_quality = thumb_quality
 
         self._content = None
         self._content_mtime = None
@@ -68,6 +89,28 @@ class GalleryCollection(Cache):
             self._content = content
             self._content_mtime = content_mtime
         return iter(self._content)
+
+    @property
+    def cache_dir(self):
+        return self._resizer_pool.cache_dir
+
+    @property
+    def thumb_size(self):
+        return self._thumb_size
+
+    @property
+    def thumb_quality(self):
+        return self._thumb_quality
+
+    @property
+    def stats(self):
+        return {
+                'resizer': self._resizer_pool.stats,
+        }
+
+    def flush_cache_index(self):
+        return self._resizer_pool.flush_cache_index()
+
     def _fetch(self, name):
         return Gallery(collection=self,
                 gallery_node=self._root_node.join_node(name))
@@ -84,6 +127,7 @@ class Gallery(Mapping):
 
         self._content_mtime = None
         self._content = None
+        self._content_order = None
         self._links = None
         self._content_prev_order = None
         self._content_next_order = None
@@ -164,10 +208,22 @@ class Gallery(Mapping):
             self._content = OrderedDict(sorted(content.items(),
                 key=lambda i : i[0]))
             self._content_mtime = content_mtime_now
+            self._content_order = None
             self._content_prev_order = None
             self._content_next_order = None
         return self._content
 
+    def get_page(self, offset=0, limit=None):
+        """
+        Return the photos in the given range, in gallery order.
+        """
+        content = self._get_content()
+        if self._content_order is None:
+            self._content_order = list(content.values())
+        if limit is None:
+            return self._content_order[offset:]
+        return self._content_order[offset:offset + limit]
+
     def _get_prev(self, name):
         if self._content_prev_order is None:
             content = list(self._get_content().keys())
@@ -182,23 +238,104 @@ class Gallery(Mapping):
                 content[:-1], content[1:]))
         return self._content_next_order[name]
 
+    @property
+    def meta_mtimes(self):
+        """
+        Return the modification times of the gallery directory and its
+        metadata file.
+        """
+        return (self._fs_node.stat.st_mtime,
+                self._fs_cache[self._fs_node.join(GALLERY_META_FILE)]\
+                        .stat.st_mtime)
+
     @property
     def _meta(self):
         return self._meta_cache[self._fs_node.join(GALLERY_META_FILE)]
 
     @coroutine
     def get_resized(self, photo, width=None, height=None, quality=60,
-            rotation=0.0, img_format=None, orientation=0):
+            rotation=0.0, img_format=None, orientation=0,
+            fast_downscale=None, priority=None, cancel=None):
         if isinstance(photo, Photo):
             orientation = photo.orientation
             photo = photo.name
 
         result = yield self._resizer_pool.get_resized(
+                gallery=self.name, photo=photo, width=width, height=height,
+                quality=quality, rotation=rotation, img_format=img_format,
+                orientation=orientation, fast_downscale=fast_downscale,
+                priority=priority, cancel=cancel)
+        raise Return(result)
+
+    def get_rendition(self, photo, width=None, height=None, quality=60,
+            rotation=0.0, img_format=None, orientation=0):
+        if isinstance(photo, Photo):
+            orientation = photo.orientation
+            photo = photo.name
+
+        return self._resizer_pool.get_rendition(
                 gallery=self.name, photo=photo, width=width, height=height,
                 quality=quality, rotation=rotation, img_format=img_format,
                 orientation=orientation)
+
+    @coroutine
+    def get_rendition_data(self, rendition, fast_downscale=None,
+            priority=None, cancel=None):
+        result = yield self._resizer_pool.get_rendition_data(
+                rendition, fast_downscale=fast_downscale, priority=priority,
+                cancel=cancel)
+        raise Return(result)
+
+    @coroutine
+    def get_rendition_path(self, rendition, fast_downscale=None,
+            priority=None, cancel=None):
+        result = yield self._resizer_pool.get_rendition_path(
+                rendition, fast_downscale=fast_downscale, priority=priority,
+                cancel=cancel)
+        raise Return(result)
+
+    def get_cache_stat(self, rendition):
+        return self._resizer_pool.get_cache_stat(rendition)
+
+    def get_sheet_map(self, renditions, offset=0, limit=None):
+        """
+        Return the layout of the contact sheets of the given thumbnail
+        renditions of the photos in the given range of this gallery.
+        """
+        self._get_content()
+        return self._resizer_pool.get_sheet_map(self.name, renditions,
+                self._content_mtime, offset, limit)
+
+    def get_sheet_path(self, sheet):
+        return self._resizer_pool.get_sheet_path(self.name, sheet)
+
+    @coroutine
+    def get_contact_sheet(self, renditions, sheet_map, index):
+        """
+        Return the path of a contact sheet of the sheet map, building it if
+        needed.
+        """
+        result = yield self._resizer_pool.get_contact_sheet(self.name,
+                renditions, sheet_map, index)
         raise Return(result)
 
+    def get_fallback(self, rendition):
+        return self._resizer_pool.get_fallback(rendition)
+
+    def get_load(self, rendition, priority=None):
+        return self._resizer_pool.get_load(rendition, priority)
+
+    @coroutine
+    def load_properties(self, photos=None, priority=PRIORITY_INTERACTIVE):
+        """
+        Ensure the properties of the photos in this gallery (or those named)
+        are indexed before they are needed.
+        """
+        if photos is None:
+            photos = list(self._get_content().keys())
+        yield self._resizer_pool.fetch_properties(self.name, photos,
+                priority=priority)
+
     @property
     def first(self):
         return list(self._get_content().keys())[0]
@@ -209,11 +346,20 @@ class Gallery(Mapping):
 
     @property
     def meta(self):
+        return self.get_meta()
+
+    def get_meta(self, offset=0, limit=None):
+        """
+        Return the gallery metadata, listing the photos in the given range.
+        """
         return {
                 'name': self.name,
                 'title': self.title,
                 'desc': self.desc,
-                'content': list(self.keys())
+                'content': [photo.name
+                    for photo in self.get_page(offset, limit)],
+                'offset': offset,
+                'total': len(self),
         }
 
     # Collection services
@@ -228,3 +374,11 @@ class Gallery(Mapping):
     @property
     def _resizer_pool(self):
         return self._collection()._resizer_pool
+
+    @property
+    def thumb_size(self):
+        return self._collection().thumb_size
+
+    @property
+    def thumb_quality(self):
+        return self._collection().thumb_quality
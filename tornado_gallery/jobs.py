@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import logging
+
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from .warm import CacheWarmer, DEFAULT_RENDITIONS
+
+# Job states
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# How many renditions a background job may have in flight at once
+DEFAULT_JOB_CONCURRENCY = 1
+
+
+class GenerateJob(object):
+    """
+    A background render of all the renditions of a gallery's photos.
+    """
+
+    def __init__(self, gallery, warmer):
+        self._gallery = gallery
+        self._warmer = warmer
+        self._state = JOB_RUNNING
+        self._error = None
+
+    @property
+    def gallery(self):
+        return self._gallery
+
+    @property
+    def finished(self):
+        return self._state != JOB_RUNNING
+
+    @property
+    def status(self):
+        status = self._warmer.progress
+        status.update({
+            'gallery': self._gallery,
+            'state': self._state,
+            'error': self._error,
+        })
+        return status
+
+    def wait(self, timeout=None):
+        """
+        Wait for progress to be made, or for the timeout (in seconds) to
+        elapse.
+        """
+        if timeout is not None:
+            timeout = IOLoop.current().time() + timeout
+        return self._warmer.changed.wait(timeout)
+
+    @coroutine
+    def run(self, log):
+        try:
+            failed = yield self._warmer.run()
+            self._state = JOB_DONE
+            if failed:
+                self._error = '%d renditions failed' % failed
+        except Exception as e:
+            log.exception('Job for %s failed', self._gallery)
+            self._state = JOB_FAILED
+            self._error = str(e)
+        finally:
+            self._warmer.changed.notify_all()
+
+
+class JobManager(object):
+    """
+    Runs background render jobs, at most one per gallery.  Jobs render at
+    batch priority, and each keeps only a few renditions in flight.
+    """
+
+    def __init__(self, collection, specs=DEFAULT_RENDITIONS,
+            size_ladder=None, concurrency=DEFAULT_JOB_CONCURRENCY,
+            log=None):
+        if log is None:
+            log = logging.getLogger(self.__class__.__module__)
+
+        self._log = log
+        self._collection = collection
+        self._specs = specs
+        self._size_ladder = size_ladder
+        self._concurrency = concurrency
+        self._jobs = {}
+
+    def __getitem__(self, gallery):
+        return self._jobs[gallery]
+
+    def start(self, gallery):
+        """
+        Start rendering the gallery named, unless it is already underway.
+        Returns the job.
+        """
+        job = self._jobs.get(gallery)
+        if (job is not None) and (not job.finished):
+            return job
+
+        # Raises KeyError if there's no such gallery
+        self._collection[gallery]
+
+        warmer = CacheWarmer(self._collection, specs=self._specs,
+                galleries=[gallery], size_ladder=self._size_ladder,
+                concurrency=self._concurrency,
+                log=self._log.getChild(gallery))
+        job = GenerateJob(gallery, warmer)
+        self._jobs[gallery] = job
+        IOLoop.current().add_callback(job.run, self._log)
+        self._log.info('Started job for %s', gallery)
+        return job
+
+    @property
+    def stats(self):
+        return dict((gallery, job.status)
+                for (gallery, job) in self._jobs.items())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# What to do with a request that is not on the ladder
+LADDER_REDIRECT = 'redirect'
+LADDER_SERVE = 'serve'
+LADDER_MODES = (LADDER_REDIRECT, LADDER_SERVE)
+
+# Decimal places qualities and rotations are given to in URIs and cache names
+URI_PRECISION = 6
+
+
+def uri_form(width, height, quality, rotation):
+    """
+    Return rendition parameters as they appear in a URI, so that two sets of
+    parameters naming the same URI compare equal.
+    """
+    return (width, height, round(quality, URI_PRECISION),
+            round(rotation, URI_PRECISION))
+
+
+class SizeLadder(object):
+    """
+    Snaps requested image parameters to a fixed set of values, so that only
+    a bounded number of renditions of any photo can be requested.  Any of
+    the sizes, qualities or rotation step may be omitted, in which case
+    that parameter is passed through unchanged.
+    """
+
+    def __init__(self, sizes=None, qualities=None, rotation_step=None):
+        self._sizes = sorted(sizes) if sizes else None
+        self._qualities = sorted(qualities) if qualities else None
+        self._rotation_step = rotation_step or None
+
+    @staticmethod
+    def _snap_up(value, steps):
+        # Smallest step that is at least the value, or the largest.
+        for step in steps:
+            if step >= value:
+                return step
+        return steps[-1]
+
+    def snap_size(self, size):
+        if (size is None) or (self._sizes is None):
+            return size
+        return self._snap_up(size, self._sizes)
+
+    def snap_quality(self, quality):
+        if self._qualities is None:
+            return quality
+        return float(self._snap_up(quality, self._qualities))
+
+    def snap_rotation(self, rotation):
+        if self._rotation_step is None:
+            return rotation
+        step = self._rotation_step
+        # Round off the error of fractional steps, or the snapped rotation
+        # would not survive a round trip through its URI.
+        return round(round(rotation / step) * step, URI_PRECISION) % 360.0
+
+    def snap(self, width, height, quality, rotation):
+        """
+        Return the canonical width, height, quality and rotation for those
+        requested.
+        """
+        return (self.snap_size(width), self.snap_size(height),
+                self.snap_quality(quality), self.snap_rotation(rotation))
+
+
+def parse_steps(steps, convert=int):
+    """
+    Parse a comma-separated list of steps given on the command line.
+    """
+    if not steps:
+        return None
+    return [convert(step) for step in steps.split(',') if step.strip()]
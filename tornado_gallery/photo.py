@@ -15,6 +15,8 @@ DEFAULT_HEIGHT = 540
 DEFAULT_QUALITY = 60.0
 DEFAULT_ROTATION = 0.0
 THUMB_SIZE = 100
+THUMB_QUALITY = 25.0
+THUMB_FORMAT = 'image/jpeg'
 
 
 class Photo(object):
@@ -68,18 +70,24 @@ class Photo(object):
     @property
     def thumbwidth(self):
         ratio = self.ratio
+        thumb_size = self._gallery().thumb_size
         if ratio > 1.0:
-            return THUMB_SIZE
+            return thumb_size
         else:
-            return int((THUMB_SIZE * ratio) + 0.5)
+            return int((thumb_size * ratio) + 0.5)
 
     @property
     def thumbheight(self):
         ratio = self.ratio
+        thumb_size = self._gallery().thumb_size
         if ratio > 1.0:
-            return int((THUMB_SIZE / ratio) + 0.5)
+            return int((thumb_size / ratio) + 0.5)
         else:
-            return THUMB_SIZE
+            return thumb_size
+
+    @property
+    def thumbquality(self):
+        return self._gallery().thumb_quality
 
     @property
     def annotation(self):
@@ -167,6 +175,19 @@ class Photo(object):
 
         return meta
 
+    @property
+    def meta_mtimes(self):
+        """
+        Return the modification times of the photo and its metadata file,
+        which its metadata is derived from (with the gallery's).
+        """
+        try:
+            meta_mtime = self._meta_node.stat.st_mtime
+        except KeyError:
+            meta_mtime = None
+        stat = self._fs_node.stat
+        return (stat.st_mtime, stat.st_size, meta_mtime)
+
     def get_fit_size(self, width=None, height=None):
         """
         Get the actual size of a photo that fits in the bounding box given.
@@ -191,7 +212,7 @@ class Photo(object):
 
         # Format; if given
         if img_format is not None:
-            uri += '/%s' % (img_format.rsplit('/',1).lower())
+            uri += '/%s' % (img_format.rsplit('/',1)[-1].lower())
 
         return uri
 
@@ -213,16 +234,56 @@ class Photo(object):
         return self._gallery()._meta_cache[meta][key]
 
     # Gallery services
+    @coroutine
+    def load_properties(self):
+        yield self._gallery().load_properties([self.name])
+
     @coroutine
     def get_resized(self, width=None, height=None, quality=None,
-            rotation=0.0, img_format=None):
+            rotation=0.0, img_format=None, fast_downscale=None,
+            priority=None, cancel=None):
         result = yield self._gallery().get_resized(
+                photo=self.name, width=width, height=height,
+                quality=quality or self.preferred_quality,
+                rotation=rotation, img_format=img_format,
+                orientation=self.orientation,
+                fast_downscale=fast_downscale, priority=priority,
+                cancel=cancel)
+        raise Return(result)
+
+    def get_rendition(self, width=None, height=None, quality=None,
+            rotation=0.0, img_format=None):
+        return self._gallery().get_rendition(
                 photo=self.name, width=width, height=height,
                 quality=quality or self.preferred_quality,
                 rotation=rotation, img_format=img_format,
                 orientation=self.orientation)
+
+    @coroutine
+    def get_rendition_data(self, rendition, fast_downscale=None,
+            priority=None, cancel=None):
+        result = yield self._gallery().get_rendition_data(
+                rendition, fast_downscale=fast_downscale, priority=priority,
+                cancel=cancel)
         raise Return(result)
 
+    @coroutine
+    def get_rendition_path(self, rendition, fast_downscale=None,
+            priority=None, cancel=None):
+        result = yield self._gallery().get_rendition_path(
+                rendition, fast_downscale=fast_downscale, priority=priority,
+                cancel=cancel)
+        raise Return(result)
+
+    def get_cache_stat(self, rendition):
+        return self._gallery().get_cache_stat(rendition)
+
+    def get_fallback(self, rendition):
+        return self._gallery().get_fallback(rendition)
+
+    def get_load(self, rendition, priority=None):
+        return self._gallery().get_load(rendition, priority)
+
     @property
     def _meta_cache(self):
         return self._gallery()._meta_cache
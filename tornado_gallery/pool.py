@@ -1,31 +1,142 @@
 from tornado.gen import coroutine, Future, Return
 from tornado.ioloop import IOLoop
-from tornado.queues import Queue
-from tornado.locks import Semaphore
-from threading import Thread
 from multiprocessing import cpu_count
-from sys import exc_info
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+import logging
+
+
+# Worker back-ends
+BACKEND_THREAD = 'thread'
+BACKEND_PROCESS = 'process'
+BACKENDS = (BACKEND_THREAD, BACKEND_PROCESS)
+
+# Priority classes, most urgent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_THUMBNAIL = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = ('interactive', 'thumbnail', 'batch')
+
+# Workers held back for interactive requests by default
+DEFAULT_RESERVE = {PRIORITY_INTERACTIVE: 1}
+
+# Queued jobs are promoted one class for each this many seconds waited
+DEFAULT_AGING = 5.0
+
+# Weight given to each job's run time in the average used to estimate waits
+SERVICE_TIME_WEIGHT = 0.2
+
+
+class JobCancelled(Exception):
+    """
+    Raised when a queued job is dropped before it was started.
+    """
+    pass
 
 
 class WorkerPool(object):
     """
-    The WorkerPool object represents a pool of worker threads which
-    each run a task in an external thread.
+    The WorkerPool object represents a pool of long-lived workers which
+    each run a task either in a thread or in a separate process.  With the
+    process back-end, the functions given, their arguments and their results
+    must all be picklable.
+
+    Each job is given a priority class.  Waiting jobs are started in class
+    order, oldest first, and workers can be reserved so that only jobs of a
+    given class or more urgent may use them.  Jobs are promoted as they
+    wait, so the less urgent classes are not starved.
+
+    A job may be given a function that says whether it is still wanted;
+    this is checked whenever the queues are consulted, and unwanted jobs are
+    dropped wherever they are in the queue.  Jobs already started always run
+    to the end.
+
+    If a memory budget is given, each job may declare an estimated cost in
+    bytes, and the next job waits until the jobs running leave room for it.
+    A job is always started if nothing else is running.
+
+    If a worker process dies mid-job, the jobs running in the pool fail with
+    BrokenProcessPool and a fresh set of workers is started.
     """
-    def __init__(self, workers=None, io_loop=None):
+    def __init__(self, workers=None, io_loop=None, backend=BACKEND_PROCESS,
+            reserve=None, aging=DEFAULT_AGING, memory_budget=None, log=None):
+        if log is None:
+            log = logging.getLogger(self.__class__.__module__)
         if workers is None:
             workers = cpu_count()
         if io_loop is None:
             io_loop = IOLoop.current()
+        if reserve is None:
+            reserve = DEFAULT_RESERVE
+        self._log = log
         self._io_loop = io_loop
-        self._sem = Semaphore(workers)
-        self._queue = Queue()
-        self._active = False
+        self._size = workers
+        self._aging = aging
+        self._busy = 0
+        self._memory_budget = memory_budget
+        self._memory_used = 0
+        self._memory_waits = 0
+        self._service_time = None
+        self._queues = [deque() for name in PRIORITY_NAMES]
+
+        # Work out how many workers each class may occupy, always leaving
+        # at least one for the least urgent.
+        self._limits = []
+        held = 0
+        for priority in range(len(PRIORITY_NAMES)):
+            self._limits.append(max(workers - held, 1))
+            held += reserve.get(priority, 0)
+
+        # Per-class statistics
+        self._submitted = [0 for name in PRIORITY_NAMES]
+        self._running = [0 for name in PRIORITY_NAMES]
+        self._cancelled = [0 for name in PRIORITY_NAMES]
+        self._wait_total = [0.0 for name in PRIORITY_NAMES]
+        self._wait_max = [0.0 for name in PRIORITY_NAMES]
+
+        if backend not in BACKENDS:
+            raise ValueError('Unknown back-end %r' % backend)
+        self._backend = backend
+        self._workers = self._start_workers()
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def _start_workers(self):
+        """
+        Start a set of workers for the back-end.
+        """
+        if self._backend == BACKEND_PROCESS:
+            return ProcessPoolExecutor(self._size)
+        return ThreadPoolExecutor(self._size)
+
+    def _restart_workers(self, broken):
+        """
+        Replace the given set of workers, if it is still ours, after one of
+        its processes died.
+        """
+        if self._workers is not broken:
+            return
+        self._log.warning('A worker process died; restarting the workers')
+        broken.shutdown(wait=False)
+        self._workers = self._start_workers()
+
+    def close(self):
+        """
+        Shut down the workers, waiting for the jobs they are running.
+        """
+        self._workers.shutdown(wait=True, cancel_futures=True)
 
     @coroutine
-    def apply(self, func, args=None, kwds=None):
+    def apply(self, func, args=None, kwds=None,
+            priority=PRIORITY_INTERACTIVE, is_cancelled=None, cost=0):
         """
-        Enqueue a request to be processed in a worker thread.
+        Enqueue a request to be processed in a worker.  If is_cancelled is
+        given and returns True before the job is started, the job is dropped
+        and JobCancelled raised.  cost is the memory the job is expected to
+        need, in bytes.
         """
         if args is None: args = ()
         if kwds is None: kwds = {}
@@ -33,61 +144,176 @@ class WorkerPool(object):
         # Our result placeholder
         future = Future()
 
-        # Enqueue the request
-        yield self._queue.put((future, func, args, kwds))
-
-        # Kick-start the queue manager if not already running
-        self._io_loop.add_callback(self._queue_manager)
+        # Enqueue the request, and start it if there's a worker free.
+        self._queues[priority].append((self._io_loop.time(),
+            future, func, args, kwds, is_cancelled, cost))
+        self._submitted[priority] += 1
+        self._dispatch()
 
         # Get back the result
         result = yield future
         raise Return(result)
 
-    @coroutine
-    def _apply(self, future, func, args=None, kwds=None):
+    def _drop_cancelled(self):
         """
-        Execute a function in a worker thread.  Wrapper function.
+        Drop the queued jobs nobody wants any more.
         """
-        yield self._sem.acquire()
+        for (priority, queue) in enumerate(self._queues):
+            wanted = deque()
+            for job in queue:
+                is_cancelled = job[5]
+                if (is_cancelled is not None) and is_cancelled():
+                    self._cancelled[priority] += 1
+                    job[1].set_exception(JobCancelled())
+                else:
+                    wanted.append(job)
+            if len(wanted) != len(queue):
+                self._queues[priority] = wanted
 
-        # Receive the result back; sets the future result
-        def _recv_result(err, res):
-            self._sem.release()
-            if err is not None:
-                future.set_exc_info(err)
-            else:
-                future.set_result(res)
+    def _next_job(self):
+        """
+        Pick the next job to run, if any may run now.
+        """
+        now = self._io_loop.time()
+        best = None
+        for (priority, queue) in enumerate(self._queues):
+            if not queue:
+                continue
 
-        # Run the function; in a worker thread
-        def _exec():
-            err = None
-            res = None
+            queued_at = queue[0][0]
+            effective = priority
+            if self._aging:
+                promotion = int((now - queued_at) / self._aging)
+                effective = max(priority - promotion, 0)
+            if self._busy >= self._limits[effective]:
+                continue
 
-            try:
-                res = func(*args, **kwds)
-            except:
-                err = exc_info()
+            if (best is None) or ((effective, queued_at) < best[:2]):
+                best = (effective, queued_at, priority)
 
-            self._io_loop.add_callback(_recv_result, err, res)
+        if best is None:
+            return None
 
-        # Spawn the worker thread
-        thread = Thread(target=_exec)
-        thread.start()
+        # Wait for memory if the job won't fit alongside those running.
+        priority = best[2]
+        cost = self._queues[priority][0][6]
+        if (self._memory_budget is not None) and self._busy and \
+                (self._memory_used + cost > self._memory_budget):
+            self._memory_waits += 1
+            return None
 
-    @coroutine
-    def _queue_manager(self):
+        (queued_at, future, func, args, kwds, _, cost) = \
+                self._queues[priority].popleft()
+        waited = now - queued_at
+        self._wait_total[priority] += waited
+        self._wait_max[priority] = max(self._wait_max[priority], waited)
+        return (priority, future, func, args, kwds, cost)
+
+    def get_load(self, priority=PRIORITY_INTERACTIVE):
         """
-        Queue manager co-routine.
+        Return the number of jobs that would start before a new job of the
+        given class, and an estimate of how long (in seconds) it would wait.
         """
-        if self._active:
-            # Already active
-            return
+        self._drop_cancelled()
+        ahead = sum(len(queue) for queue in self._queues[:priority + 1])
+        limit = self._limits[priority]
+        if (not ahead) and (self._busy < limit):
+            return (0, 0.0)
+        return (ahead, (ahead + 1) * (self._service_time or 0.0) / limit)
+
+    def _dispatch(self):
+        """
+        Hand waiting jobs to free workers.
+        """
+        self._drop_cancelled()
+        while self._busy < self._size:
+            job = self._next_job()
+            if job is None:
+                return
+            self._apply(*job)
+
+    def _apply(self, priority, future, func, args, kwds, cost):
+        """
+        Execute a function in a worker.  Wrapper function.
+        """
+        self._busy += 1
+        self._memory_used += cost
+        self._running[priority] += 1
+        started = self._io_loop.time()
 
+        # Receive the result back; sets the future result
+        def _recv_result(job):
+            self._busy -= 1
+            self._memory_used -= cost
+            self._running[priority] -= 1
+            taken = self._io_loop.time() - started
+            if self._service_time is None:
+                self._service_time = taken
+            else:
+                self._service_time += SERVICE_TIME_WEIGHT \
+                        * (taken - self._service_time)
+            try:
+                future.set_result(job.result())
+            except BrokenProcessPool as err:
+                self._restart_workers(workers)
+                future.set_exception(err)
+            except Exception as err:
+                future.set_exception(err)
+            self._dispatch()
+
+        # Called from the executor's thread once the job is done
+        def _on_done(job):
+            self._io_loop.add_callback(_recv_result, job)
+
+        # Hand the function to a worker; the workers may have died since
+        # the last job finished.
         try:
-            self._active = True
-            while True:
-               (future, func, args, kwds) = yield self._queue.get()
-               self._io_loop.add_callback(
-                       self._apply, future, func, args, kwds)
-        finally:
-            self._active = False
+            job = self._workers.submit(func, *args, **kwds)
+        except BrokenProcessPool:
+            self._restart_workers(self._workers)
+            job = self._workers.submit(func, *args, **kwds)
+        workers = self._workers
+        job.add_done_callback(_on_done)
+
+    @property
+    def service_time(self):
+        """
+        Recent average time (in seconds) a job takes to run, or None.
+        """
+        return self._service_time
+
+    @property
+    def memory_stats(self):
+        """
+        Return the memory budget, how much of it is reserved by running
+        jobs, and how many times a job has had to wait for it.
+        """
+        return {
+                'budget': self._memory_budget,
+                'used': self._memory_used,
+                'waits': self._memory_waits,
+        }
+
+    @property
+    def stats(self):
+        """
+        Return the queue depth, running jobs and time spent queued (seconds)
+        for each priority class.
+        """
+        self._drop_cancelled()
+        stats = {}
+        for (priority, name) in enumerate(PRIORITY_NAMES):
+            started = self._submitted[priority] \
+                    - self._cancelled[priority] \
+                    - len(self._queues[priority])
+            stats[name] = {
+                    'queued': len(self._queues[priority]),
+                    'running': self._running[priority],
+                    'limit': self._limits[priority],
+                    'submitted': self._submitted[priority],
+                    'cancelled': self._cancelled[priority],
+                    'wait_mean': self._wait_total[priority] / started \
+                            if started else 0.0,
+                    'wait_max': self._wait_max[priority],
+            }
+        return stats
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import fcntl
+import json
+import logging
+import os
+import os.path
+import threading
+
+PROPERTIES_FILE = '.properties.json'
+PROPERTIES_VERSION = 3
+
+
+class PropertiesIndex(object):
+    """
+    A persistent index of the raw properties (dimensions, format,
+    orientation and EXIF data) of the photos in a gallery.  Entries are
+    keyed by photo name and are considered current only whilst the original
+    file's modification time and size match those recorded with the entry.
+
+    Several processes may share an index.  Each merges its new entries with
+    those on disk when saving, and re-reads the index if it has changed
+    when asked for a photo it does not have.
+
+    The index may be saved from another thread whilst entries are being
+    added.
+    """
+
+    def __init__(self, index_path, log=None):
+        if log is None:
+            log = logging.getLogger(self.__class__.__module__)
+
+        self._log = log
+        self._path = index_path
+        self._entries = None
+        self._mtime = None
+        self._updated = set()
+        # Guards the entries whilst a save merges and snapshots them
+        self._lock = threading.Lock()
+
+    def _read(self):
+        """
+        Read the index from disk, returning its entries.
+        """
+        entries = {}
+        try:
+            with open(self._path, 'rt') as index_file:
+                self._mtime = os.fstat(index_file.fileno()).st_mtime
+                data = json.load(index_file)
+            if data.get('version') == PROPERTIES_VERSION:
+                entries = data['photos']
+            else:
+                self._log.info('Discarding index %s (version %s)',
+                        self._path, data.get('version'))
+        except (IOError, OSError):
+            # No index yet
+            pass
+        except (ValueError, KeyError, AttributeError):
+            self._log.warning('Discarding corrupt index %s', self._path,
+                    exc_info=1)
+        return entries
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = self._read()
+
+    def _merge(self):
+        """
+        Merge the entries on disk with ours; ours take precedence.
+        """
+        entries = self._read()
+        with self._lock:
+            entries.update((photo, self._entries[photo])
+                    for photo in self._updated)
+            self._entries = entries
+
+    def _refresh(self):
+        """
+        Pick up entries written by other processes since we last read the
+        index.  Returns True if there were any.
+        """
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._merge()
+        return True
+
+    def get(self, photo, stat):
+        """
+        Return the indexed properties of a photo, or None if the photo is
+        not in the index or its entry does not match the stat() result given.
+        """
+        self._load()
+        try:
+            entry = self._entries[photo]
+        except KeyError:
+            if not self._refresh():
+                return None
+            entry = self._entries.get(photo)
+            if entry is None:
+                return None
+
+        if (entry['mtime'] != stat.st_mtime) \
+                or (entry['size'] != stat.st_size):
+            return None
+        return entry['properties']
+
+    def set(self, photo, stat, properties):
+        """
+        Record the properties of a photo against the stat() result given.
+        """
+        self._load()
+        with self._lock:
+            self._entries[photo] = {
+                    'mtime': stat.st_mtime,
+                    'size': stat.st_size,
+                    'properties': properties,
+            }
+            self._updated.add(photo)
+
+    @property
+    def dirty(self):
+        """
+        Whether there are entries not yet saved.
+        """
+        return bool(self._updated)
+
+    def save(self):
+        """
+        Write the index out to disk if it has changed, merging in any
+        entries written by other processes.
+        """
+        if not self._updated:
+            return
+
+        index_dir = os.path.dirname(self._path)
+        os.makedirs(index_dir, exist_ok=True)
+
+        # Hold the lock whilst merging so no other process's entries are lost.
+        with open('%s.lock' % self._path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self._merge()
+            with self._lock:
+                entries = dict(self._entries)
+
+            # Write to a temporary file then move it into place so readers
+            # never see a partially written index.
+            temp_path = '%s.%d.%d.tmp' % (self._path, os.getpid(),
+                    threading.get_ident())
+            with open(temp_path, 'wt') as index_file:
+                json.dump({
+                    'version': PROPERTIES_VERSION,
+                    'photos': entries,
+                }, index_file)
+            os.rename(temp_path, self._path)
+            self._mtime = os.stat(self._path).st_mtime
+
+        # Entries set again whilst we were writing still need saving.
+        with self._lock:
+            self._updated = set(photo for photo in self._updated
+                    if self._entries[photo] is not entries.get(photo))
+        self._log.debug('Wrote %d entries to %s',
+                len(entries), self._path)
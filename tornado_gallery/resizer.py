@@ -1,23 +1,37 @@
 from tornado.gen import coroutine, Return
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Lock
 from PIL import Image
 from sys import exc_info
 from io import BytesIO
 from enum import Enum
-from tornado.locks import Semaphore
 import magic
 import logging
+import re
+import json
+from hashlib import sha1
 
 try:
     import piexif
 except ImportError:
     pass
 
-from os import makedirs
+from os import makedirs, stat
+from concurrent.futures import ThreadPoolExecutor
+import os
+import os.path
+import fcntl
+from contextlib import contextmanager
+from uuid import uuid4
+from math import ceil, cos, sin, radians
 
 import multiprocessing
-from .pool import WorkerPool
-from weakref import WeakValueDictionary
+from .pool import WorkerPool, BACKEND_PROCESS, DEFAULT_AGING, \
+        PRIORITY_INTERACTIVE, PRIORITY_THUMBNAIL, PRIORITY_BATCH, \
+        JobCancelled
+from .cache import LRUCache
+from .diskcache import CacheManager, scan_cache, trim_cache
+from .properties import PropertiesIndex, PROPERTIES_FILE
 
 # Filename extension mappings
 _FORMAT_EXT = {
@@ -33,6 +47,65 @@ _FORMAT_PIL = {
         'image/gif':    'GIF'
 }
 
+# Use the fast downscale path when shrinking by at least this much
+DEFAULT_FAST_DOWNSCALE_RATIO = 2.0
+
+# How close to the target size the reduction step gets before resampling;
+# at 3.0 the result is indistinguishable from a full Lanczos resample.
+FAST_REDUCING_GAP = 3.0
+
+
+# Default memory budget for recently served images, in bytes
+DEFAULT_MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+
+# Kinds of operation shared between concurrent requests
+FLIGHT_RENDER = 'renders'
+FLIGHT_READ = 'reads'
+FLIGHT_SHEET = 'sheets'
+FLIGHTS = (FLIGHT_RENDER, FLIGHT_READ, FLIGHT_SHEET)
+
+# How often to trim the disk cache, in seconds
+DEFAULT_CACHE_TRIM_INTERVAL = 300.0
+
+# Renditions no larger than this either way are queued as thumbnails
+THUMBNAIL_PRIORITY_SIZE = 200
+
+# Bytes per pixel of a decoded image; Pillow pads RGB to 32 bits
+PIXEL_BYTES = 4
+
+# Allowance for decoder buffers and allocator slack, going by peak RSS
+MEMORY_OVERHEAD = 1.5
+
+# Cache file name, less the gallery and photo name prefix
+_CACHE_NAME_RE = re.compile(r'^(\d+)x(\d+)-(\d+)-(-?\d+\.\d+)\.([a-z]+)$')
+
+# Thumbnails per row and rows per contact sheet; a page with more
+# thumbnails than fit is split over several sheets
+SHEET_COLUMNS = 10
+SHEET_ROWS = 10
+
+# Largest width or height of a contact sheet; JPEG's limit
+SHEET_MAX_DIMENSION = 65500
+
+# Pyramid levels: how many halvings, and the JPEG quality to store them at
+PYRAMID_DEPTH = 5
+PYRAMID_QUALITY = 90
+
+# Alpha below this is fully transparent once reduced to a GIF palette
+GIF_ALPHA_THRESHOLD = 128
+
+# EXIF orientation to Pillow transposition
+_ORIENTATION_TRANSPOSE = {
+        2:  Image.FLIP_LEFT_RIGHT,
+        3:  Image.ROTATE_180,
+        4:  Image.FLIP_TOP_BOTTOM,
+        5:  Image.TRANSPOSE,
+        6:  Image.ROTATE_270,
+        7:  Image.TRANSVERSE,
+        8:  Image.ROTATE_90,
+}
+
+
 class ImageFormat(Enum):
     JPEG    = 'image/jpeg'
     PNG     = 'image/png'
@@ -80,8 +153,132 @@ def calc_dimensions(raw_width, raw_height, width=None, height=None):
             return (scaled_width, height)
 
 
+def rotated_dimensions(width, height, rotation=0.0):
+    """
+    Return the dimensions of the bounding box of an image of the given size
+    after rotation by the given angle (in degrees).
+    """
+    if not (rotation % 360.0):
+        return (width, height)
+
+    angle = radians(rotation)
+    (cos_a, sin_a) = (abs(cos(angle)), abs(sin(angle)))
+    return (width * cos_a + height * sin_a,
+            width * sin_a + height * cos_a)
+
+
+def oriented_dimensions(width, height, orientation=0):
+    """
+    Return the dimensions of an image of the given size once the given EXIF
+    orientation has been applied.
+    """
+    if orientation in (5, 6, 7, 8):
+        return (height, width)
+    return (width, height)
+
+
+def estimate_memory(src_width, src_height, width, height, rotation=0.0,
+        fast_ratio=None):
+    """
+    Estimate the memory, in bytes, needed to resize an (oriented) image of
+    the source size to the size given.  This allows for the decoded image,
+    the reduced copy and the copies made rotating and converting the result.
+    """
+    (rotated_width, rotated_height) = rotated_dimensions(
+            src_width, src_height, rotation)
+    scale = max(float(width) / rotated_width,
+            float(height) / rotated_height)
+
+    # JPEG draft decoding reduces by up to 8 each way
+    decoded = src_width * src_height
+    if fast_ratio and (scale * fast_ratio <= 1.0):
+        reduction = 1
+        while (reduction < 8) and (scale * reduction * 2 <= 1.0):
+            reduction *= 2
+        decoded /= (reduction * reduction)
+
+    scaled = src_width * src_height * (min(scale, 1.0) ** 2)
+    result = width * height
+    return int(PIXEL_BYTES * MEMORY_OVERHEAD * max(decoded + scaled,
+        scaled + (2 * result), 3 * result))
+
+
+def _rotate_to(img, rotation, size):
+    """
+    Rotate the image by the given angle, expanding it to fit, and scale the
+    result to the given size.  This is done as a single affine transform.
+    """
+    (img_width, img_height) = img.size
+    (rotated_width, rotated_height) = rotated_dimensions(
+            img_width, img_height, rotation)
+    (width, height) = size
+    x_scale = rotated_width / float(width)
+    y_scale = rotated_height / float(height)
+
+    # Map each output pixel back to the source image: scale up to the
+    # rotated bounding box, then rotate about the centres.
+    angle = -radians(rotation)
+    (cos_a, sin_a) = (cos(angle), sin(angle))
+    (centre_x, centre_y) = (rotated_width / 2.0, rotated_height / 2.0)
+    matrix = (
+            cos_a * x_scale, sin_a * y_scale,
+            (img_width / 2.0) - (cos_a * centre_x) - (sin_a * centre_y),
+            -sin_a * x_scale, cos_a * y_scale,
+            (img_height / 2.0) + (sin_a * centre_x) - (cos_a * centre_y),
+    )
+    return img.transform(size, Image.AFFINE, matrix, Image.BICUBIC)
+
+
+class Rendition(object):
+    """
+    A description of a resized photo, and where it is cached.
+    """
+
+    def __init__(self, gallery, photo, orig_node, width, height, quality,
+            rotation, img_format, orientation, cache_dir, cache_name):
+        self.gallery = gallery
+        self.photo = photo
+        self.orig_node = orig_node
+        self.width = width
+        self.height = height
+        self.quality = quality
+        self.rotation = rotation
+        self.img_format = img_format
+        self.orientation = orientation
+        self.cache_dir = cache_dir
+        self.cache_name = cache_name
+
+    @property
+    def key(self):
+        return (self.gallery, self.photo, self.width, self.height,
+                self.quality, self.rotation, self.img_format)
+
+    @property
+    def cache_path(self):
+        return os.path.join(self.cache_dir, self.cache_name)
+
+    @property
+    def etag(self):
+        """
+        A strong entity tag for the rendition; this changes if the original
+        is modified.
+        """
+        orig_stat = self.orig_node.stat
+        return '"%s"' % sha1(('%s:%r:%d' % (self.cache_name,
+            orig_stat.st_mtime, orig_stat.st_size)).encode('UTF-8')
+            ).hexdigest()
+
+
 class ResizerPool(object):
-    def __init__(self, root_dir_node, cache_subdir, num_proc=None, log=None):
+    def __init__(self, root_dir_node, cache_subdir, num_proc=None,
+            pool_backend=BACKEND_PROCESS, pool_reserve=None,
+            pool_aging=DEFAULT_AGING, memory_budget=None,
+            fast_downscale_ratio=DEFAULT_FAST_DOWNSCALE_RATIO,
+            derive=False, pyramid=False,
+            memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE,
+            cache_max_size=None, cache_max_files=None,
+            cache_trim_interval=DEFAULT_CACHE_TRIM_INTERVAL,
+            cache_trim=True, cache_index=False, log=None):
         if log is None:
             log = logging.getLogger(self.__class__.__module__)
 
@@ -89,36 +286,70 @@ class ResizerPool(object):
             num_proc = multiprocessing.cpu_count()
 
         self._log = log
-        self._pool = WorkerPool(num_proc)
+        self._pool = WorkerPool(num_proc, backend=pool_backend,
+                reserve=pool_reserve, aging=pool_aging,
+                memory_budget=memory_budget, log=log.getChild('pool'))
+        self._memory_measured = 0
+        self._memory_peak = 0
+        self._memory_underestimated = 0
+        self._fast_downscale_ratio = fast_downscale_ratio
+        self._derive = derive
+        self._pyramid = pyramid
         self._fs_node = root_dir_node
         self._cache_node = self._fs_node[cache_subdir]
-        self._mutexes = WeakValueDictionary()
+        self._flights = dict((kind, {}) for kind in FLIGHTS)
+        self._started = dict((kind, 0) for kind in FLIGHTS)
+        self._coalesced = dict((kind, 0) for kind in FLIGHTS)
+        self._interest = {}
+        self._sheets = {}
+        self._memory_cache = LRUCache(memory_cache_size,
+                log=log.getChild('memory'))
+        self._properties = {}
+        self._properties_pending = {}
+        self._properties_saving = {}
 
-    @coroutine
-    def get_resized(self, gallery, photo,
+        # Disk cache management, if there's a budget or we're asked to keep
+        # the index up to date for another process that has one.
+        if cache_index or (cache_max_size is not None) \
+                or (cache_max_files is not None):
+            self._cache_manager = CacheManager(self._cache_node.abs_path,
+                    max_size=cache_max_size, max_files=cache_max_files,
+                    log=log.getChild('diskcache'))
+            self._cache_scanned = False
+            self._cache_trimming = False
+            self._cache_trimmed = (0, 0)
+            self._cache_trim = cache_trim
+            # The access index is written from this thread alone, as it
+            # owns the index's connection.
+            self._cache_index_thread = ThreadPoolExecutor(1)
+            self._cache_trim_task = PeriodicCallback(self._trim_cache,
+                    cache_trim_interval * 1000.0)
+            self._cache_trim_task.start()
+        else:
+            self._cache_manager = None
+
+    def get_rendition(self, gallery, photo,
             width=None, height=None, quality=60,
             rotation=0.0, img_format=None, orientation=0):
         """
-        Retrieve the given photo in a resized format.
+        Work out which rendition of the photo would be served for the given
+        parameters, without rendering it.
         """
         # Determine the path to the original file.
         orig_node = self._fs_node.join_node(gallery, photo)
 
         if img_format is None:
-            # Detect from original file and quality setting.
-            with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
-                mime_type = m.id_filename(orig_node.abs_path)
-                self._log.debug('%s/%s detected format %s',
-                        gallery, photo, mime_type)
-                if mime_type == 'image/gif':
-                    img_format = ImageFormat.GIF
+            # Decide from the original's indexed format and quality setting.
+            mime_type = self.get_properties(gallery, photo)['mime_type']
+            if mime_type == 'image/gif':
+                img_format = ImageFormat.GIF
+            else:
+                if quality == 100:
+                    # Assume PNG
+                    img_format = ImageFormat.PNG
                 else:
-                    if quality == 100:
-                        # Assume PNG
-                        img_format = ImageFormat.PNG
-                    else:
-                        # Assume JPEG
-                        img_format = ImageFormat.JPEG
+                    # Assume JPEG
+                    img_format = ImageFormat.JPEG
         else:
             # Use the format given by the user
             img_format = ImageFormat(img_format)
@@ -127,51 +358,617 @@ class ResizerPool(object):
                 gallery, photo, img_format.name)
 
         # Sanitise dimensions given by user.
-        width, height = self.get_dimensions(gallery, photo, width, height)
+        width, height = self.get_dimensions(gallery, photo, width, height,
+                orientation)
         self._log.debug('%s/%s target dimensions %d by %d',
                 gallery, photo, width, height)
 
         # Determine where the file would be cached
         (cache_dir, cache_name) = self._get_cache_name(gallery, photo,
                 width,height, quality, rotation, img_format)
+        return Rendition(gallery, photo, orig_node, width, height, quality,
+                rotation, img_format, orientation, cache_dir, cache_name)
 
-        # Do we have this file?
-        data = self._read_cache(orig_node, cache_dir, cache_name)
+    @coroutine
+    def get_resized(self, gallery, photo,
+            width=None, height=None, quality=60,
+            rotation=0.0, img_format=None, orientation=0,
+            fast_downscale=None, priority=None, cancel=None):
+        """
+        Retrieve the given photo in a resized format.  fast_downscale
+        selects whether draft decoding and reduction are used when shrinking
+        the image; by default this is decided by the downscale ratio.
+        priority is the worker pool class to render in; by default this is
+        decided by the size of the rendition.  cancel is an Event which, if
+        set whilst the rendering is still queued, withdraws the request;
+        JobCancelled is then raised.
+        """
+        yield self.fetch_properties(gallery, [photo],
+                priority=PRIORITY_INTERACTIVE if priority is None \
+                        else priority)
+        rendition = self.get_rendition(gallery, photo, width, height,
+                quality, rotation, img_format, orientation)
+        data = yield self.get_rendition_data(rendition, fast_downscale,
+                priority, cancel)
+        raise Return((rendition.img_format, rendition.cache_name, data))
+
+    @coroutine
+    def get_rendition_data(self, rendition, fast_downscale=None,
+            priority=None, cancel=None):
+        """
+        Retrieve the image data for the given rendition, rendering it if
+        needed.
+        """
+        # Have we got it in memory?
+        orig_mtime = rendition.orig_node.stat.st_mtime
+        data = self._memory_cache.get(rendition.key, orig_mtime)
         if data is not None:
-            raise Return((img_format, cache_name, data))
+            self._touch(rendition, len(data))
+            raise Return(data)
+
+        # Do we have this file?
+        data = yield self._read_cache(rendition.orig_node,
+                rendition.cache_dir, rendition.cache_name)
+        if data is None:
+            # Render it, or wait for the request already rendering it.
+            with self._interested(rendition.key,
+                    None if cancel is None else cancel.is_set):
+                data = yield self._single_flight(FLIGHT_READ, rendition.key,
+                        lambda : self._fetch_rendition(rendition,
+                            fast_downscale, priority))
+
+        self._touch(rendition, len(data))
+        self._memory_cache.put(rendition.key, orig_mtime, data)
+        raise Return(data)
+
+    @coroutine
+    def _fetch_rendition(self, rendition, fast_downscale, priority):
+        """
+        Render the rendition and read it back from the cache.
+        """
+        cache_path = yield self._render(rendition.gallery,
+                rendition.photo, rendition.orig_node,
+                rendition.width, rendition.height, rendition.quality,
+                rendition.rotation, rendition.img_format,
+                rendition.orientation, fast_downscale,
+                self._get_priority(rendition, priority))
+        data = yield IOLoop.current().run_in_executor(None,
+                _read_file, cache_path)
+        raise Return(data)
+
+    @coroutine
+    def get_rendition_path(self, rendition, fast_downscale=None,
+            priority=None, cancel=None):
+        """
+        Ensure the rendition is in the cache, rendering it if needed, and
+        return the path to the cached file.
+        """
+        cache_stat = self.get_cache_stat(rendition)
+        if cache_stat is not None:
+            self._touch(rendition, cache_stat.st_size)
+            raise Return(rendition.cache_path)
+
+        with self._interested(rendition.key,
+                None if cancel is None else cancel.is_set):
+            cache_path = yield self._render(rendition.gallery,
+                    rendition.photo, rendition.orig_node,
+                    rendition.width, rendition.height, rendition.quality,
+                    rendition.rotation, rendition.img_format,
+                    rendition.orientation, fast_downscale,
+                    self._get_priority(rendition, priority))
+        if self._cache_manager is not None:
+            self._touch(rendition, stat(cache_path).st_size)
+        raise Return(cache_path)
+
+    def _get_priority(self, rendition, priority=None):
+        """
+        Decide which class of the worker pool to render the rendition in.
+        """
+        if priority is not None:
+            return priority
+        if max(rendition.width, rendition.height) <= THUMBNAIL_PRIORITY_SIZE:
+            return PRIORITY_THUMBNAIL
+        return PRIORITY_INTERACTIVE
 
-        # Locate the lock for this photo.
-        mutex_key = (gallery, photo, width, height, quality, rotation,
-                img_format)
+    def _touch(self, rendition, size):
+        """
+        Record the use of a rendition for the disk cache manager.
+        """
+        if self._cache_manager is not None:
+            self._cache_manager.touch(rendition.cache_path, size)
+
+    def _touch_file(self, cache_path):
+        """
+        Record the use of some other file in the cache, such as a pyramid
+        level or contact sheet, for the disk cache manager.
+        """
+        if self._cache_manager is not None:
+            self._cache_manager.touch(cache_path, stat(cache_path).st_size)
+
+    @coroutine
+    def flush_cache_index(self):
+        """
+        Write out the cache accesses recorded so far, if any.
+        """
+        if self._cache_manager is None:
+            return
+
+        pending = self._cache_manager.take_pending()
+        if pending:
+            yield IOLoop.current().run_in_executor(self._cache_index_thread,
+                    self._cache_manager.record, pending)
+
+    @coroutine
+    def _trim_cache(self):
+        """
+        Record recent accesses and trim the disk cache to its budget.
+        If another process trims the cache, only record the accesses.
+        """
+        if self._cache_trimming:
+            return
+
+        cache_dir = self._cache_node.abs_path
         try:
-            mutex = self._mutexes[mutex_key]
+            self._cache_trimming = True
+            try:
+                yield self.flush_cache_index()
+            except:
+                self._log.exception('Failed to record cache accesses')
+            if not self._cache_trim:
+                return
+
+            if not self._cache_scanned:
+                # Pick up anything already on disk.
+                yield self._pool.apply(func=scan_cache, args=(cache_dir,),
+                        priority=PRIORITY_BATCH)
+                self._cache_scanned = True
+
+            (files, size) = yield self._pool.apply(func=trim_cache,
+                    args=(cache_dir, self._cache_manager.max_size,
+                        self._cache_manager.max_files),
+                    priority=PRIORITY_BATCH)
+            (total_files, total_size) = self._cache_trimmed
+            self._cache_trimmed = (total_files + files, total_size + size)
+        except:
+            self._log.exception('Failed to trim cache')
+        finally:
+            self._cache_trimming = False
+
+    @property
+    def cache_dir(self):
+        return self._cache_node.abs_path
+
+    def get_cache_stat(self, rendition):
+        """
+        Return the stat() result for the rendition's cache file, or None if
+        it is not (validly) cached.
+        """
+        try:
+            cache_node = self._cache_node[rendition.cache_path]
         except KeyError:
-            mutex = Semaphore(1)
-            self._mutexes[mutex_key] = mutex
+            return None
+
+        cache_stat = cache_node.stat
+        if (cache_stat.st_size > 0) and \
+                (cache_stat.st_mtime >= rendition.orig_node.stat.st_mtime):
+            return cache_stat
+
+    def _single_flight(self, kind, key, start):
+        """
+        Return the Future of the operation of the given kind in flight for
+        the key, or start one by calling start() if there is none.
+        """
+        flights = self._flights[kind]
+        future = flights.get(key)
+        if (future is not None) and (not future.done()):
+            self._coalesced[kind] += 1
+            return future
+
+        self._started[kind] += 1
+        future = start()
+        if not future.done():
+            flights[key] = future
+            def _landed(future):
+                if flights.get(key) is future:
+                    flights.pop(key)
+            future.add_done_callback(_landed)
+        return future
+
+    @contextmanager
+    def _interested(self, key, is_cancelled):
+        """
+        Register interest in the rendering of the given key for the duration.
+        is_cancelled is a function returning True once the caller no longer
+        wants the result; callers without one are always interested.
+        """
+        interest = self._interest.setdefault(key, [])
+        interest.append(is_cancelled)
+        try:
+            yield
+        finally:
+            interest.remove(is_cancelled)
+            if not interest:
+                self._interest.pop(key, None)
+
+    def _is_cancelled(self, key):
+        """
+        Return True if nobody wants the rendering of the given key any more.
+        """
+        return all((c is not None) and c()
+                for c in self._interest.get(key, []))
+
+    def _render(self, gallery, photo, orig_node, width, height, quality,
+            rotation, img_format, orientation, fast_downscale,
+            priority=PRIORITY_INTERACTIVE, pyramid=True):
+        """
+        Render the given photo into the cache, returning a Future for the
+        path to the cached file.  Concurrent requests for the same rendition
+        share one rendering, which is dropped from the queue if everyone
+        interested in it loses interest.
+        """
+        key = (gallery, photo, width, height, quality, rotation, img_format)
+        return self._single_flight(FLIGHT_RENDER, key,
+                lambda : self._do_render(key, gallery, photo, orig_node,
+                    width, height, quality, rotation, img_format,
+                    orientation, fast_downscale, priority, pyramid))
+
+    @coroutine
+    def _do_render(self, key, gallery, photo, orig_node, width, height,
+            quality, rotation, img_format, orientation, fast_downscale,
+            priority, pyramid):
+        (cache_dir, cache_name) = self._get_cache_name(gallery, photo,
+                width,height, quality, rotation, img_format)
+
+        def is_cancelled():
+            return self._is_cancelled(key)
+
+        if fast_downscale is None:
+            fast_ratio = self._fast_downscale_ratio
+        elif fast_downscale:
+            fast_ratio = 1.0
+        else:
+            fast_ratio = None
 
-        resize_args = (gallery, photo, width, height, quality,
-                    rotation, img_format.value, orientation)
         try:
-            self._log.debug('%s/%s waiting for mutex',
-                    gallery, photo)
-            yield mutex.acquire()
-
-            # We have the semaphore, call our resize routine.
-            self._log.debug('%s/%s retrieving resized image (args=%s)',
-                    gallery, photo, resize_args)
-            (img_format, file_name, file_data) = yield self._pool.apply(
-                func=self._do_resize,
-                args=resize_args)
-            raise Return((img_format, file_name, file_data))
-        except Return:
+            # Can we start from something already in the cache?  Pyramid
+            # levels are JPEG, so cannot carry transparency.
+            source = None
+            if self._derive:
+                alpha = self.get_properties(gallery, photo).get('alpha')
+                source = self._find_source(gallery, photo, orig_node,
+                        width, height, quality, rotation, alpha)
+                if (source is None) and pyramid and self._pyramid \
+                        and (not alpha) and (not rotation) \
+                        and (quality <= PYRAMID_QUALITY):
+                    source = yield self._render_pyramid_level(
+                            gallery, photo, orig_node, width, height,
+                            orientation, priority, is_cancelled)
+
+            if source is not None:
+                # The source is already oriented and rotated.
+                (source_path, source_size) = source
+                self._log.debug('%s/%s deriving from %s',
+                        gallery, photo, source_path)
+                self._touch_file(source_path)
+                resize_args = (source_path, cache_dir, cache_name,
+                        width, height, quality, 0.0, img_format.value,
+                        0, fast_ratio)
+                cost = estimate_memory(source_size[0], source_size[1],
+                        width, height, 0.0, fast_ratio)
+            else:
+                resize_args = (orig_node.abs_path, cache_dir, cache_name,
+                        width, height, quality, rotation, img_format.value,
+                        orientation, fast_ratio)
+                properties = self.get_properties(gallery, photo)
+                cost = estimate_memory(properties['width'],
+                        properties['height'], width, height, rotation,
+                        fast_ratio)
+
+            self._log.debug('%s/%s retrieving resized image (args=%s, '\
+                    'cost=%d)', gallery, photo, resize_args, cost)
+            (cache_path, peak_rss) = yield self._pool.apply(
+                func=resize_photo_measured,
+                args=resize_args,
+                priority=priority,
+                is_cancelled=is_cancelled,
+                cost=cost)
+            self._record_memory(cache_path, cost, peak_rss)
+            raise Return(cache_path)
+        except (Return, JobCancelled):
             raise
         except:
             self._log.exception('Error resizing photo; gallery: %s, photo: %s, '\
                     'width: %d, height: %d, quality: %f, rotation: %f, format: %s',
                     gallery, photo, width, height, quality, rotation, img_format)
             raise
-        finally:
-            mutex.release()
+
+    def _iter_cached(self, gallery, photo, rotation):
+        """
+        Yield the width, height, quality and file extension of each cached
+        rendition of the photo at the given rotation, with the node of its
+        directory and its file name.  These may be out of date.
+        """
+        photo_noext = '.'.join(photo.split('.')[:-1])
+        prefix = '%s-%s-' % (gallery, photo_noext)
+        rotation = '%.6f' % rotation
+        try:
+            cache_dir_node = self._cache_node[
+                    self._cache_node.join(gallery, photo_noext)]
+        except KeyError:
+            return
+
+        for name in cache_dir_node:
+            if not name.startswith(prefix):
+                continue
+            match = _CACHE_NAME_RE.match(name[len(prefix):])
+            if match is None:
+                continue
+
+            (var_width, var_height, var_quality, var_rotation, ext) = \
+                    match.groups()
+            if var_rotation != rotation:
+                continue
+            yield (int(var_width), int(var_height), int(var_quality), ext,
+                    cache_dir_node, name)
+
+    def _is_current(self, cache_dir_node, name, orig_node):
+        """
+        Check a cached file is non-empty and no older than the original.
+        """
+        try:
+            var_stat = cache_dir_node[name].stat
+        except KeyError:
+            return False
+        return (var_stat.st_size > 0) and \
+                (var_stat.st_mtime >= orig_node.stat.st_mtime)
+
+    def _record_memory(self, cache_path, cost, peak_rss):
+        """
+        Report the memory a rendering took against its estimate.  Only
+        worker processes can be measured individually.
+        """
+        if (peak_rss is None) or (self._pool.backend != BACKEND_PROCESS):
+            return
+
+        self._log.info('%s: estimated %.1f MiB, peak RSS grew %.1f MiB',
+                os.path.basename(cache_path), cost / 1048576.0,
+                peak_rss / 1048576.0)
+        self._memory_measured += 1
+        self._memory_peak = max(self._memory_peak, peak_rss)
+        if peak_rss > cost:
+            self._memory_underestimated += 1
+
+    def _find_source(self, gallery, photo, orig_node, width, height,
+            quality, rotation, alpha=False):
+        """
+        Find the smallest up-to-date cached rendition of the photo with the
+        same rotation and aspect ratio, no lower quality, and at least the
+        size requested; returning its path and size, or None.  If the photo
+        has transparency, only PNG renditions keep it.
+        """
+        best = None
+        for (var_width, var_height, var_quality, ext, cache_dir_node,
+                name) in self._iter_cached(gallery, photo, rotation):
+            if (var_quality < quality) \
+                    or (ext == ImageFormat.GIF.ext) \
+                    or (alpha and (ext != ImageFormat.PNG.ext)) \
+                    or (var_width < width) or (var_height < height) \
+                    or ((var_width, var_height) == (width, height)):
+                continue
+
+            # Must have the same aspect ratio, give or take a pixel.
+            if abs((var_width * height) - (var_height * width)) \
+                    > max(var_width, var_height):
+                continue
+
+            area = var_width * var_height
+            if (best is not None) and (best[0] <= area):
+                continue
+
+            if self._is_current(cache_dir_node, name, orig_node):
+                best = (area, cache_dir_node.join(name),
+                        (var_width, var_height))
+
+        if best is not None:
+            return best[1:]
+
+    def get_fallback(self, rendition):
+        """
+        Find the largest up-to-date cached rendition of the photo that is no
+        larger than, but otherwise like, the one given; returning a
+        Rendition for it or None.
+        """
+        (width, height) = (rendition.width, rendition.height)
+        best = None
+        for (var_width, var_height, var_quality, ext, cache_dir_node,
+                name) in self._iter_cached(rendition.gallery,
+                        rendition.photo, rendition.rotation):
+            if (var_width > width) or (var_height > height):
+                continue
+
+            # Must have the same aspect ratio, give or take a pixel.
+            if abs((var_width * height) - (var_height * width)) \
+                    > max(var_width, var_height):
+                continue
+
+            area = var_width * var_height
+            if (best is not None) and (best[0] >= area):
+                continue
+
+            if self._is_current(cache_dir_node, name, rendition.orig_node):
+                best = (area, var_width, var_height, var_quality, ext,
+                        cache_dir_node.abs_path, name)
+
+        if best is None:
+            return None
+
+        (_, var_width, var_height, var_quality, ext, cache_dir, name) = best
+        img_format = [fmt for fmt in ImageFormat if fmt.ext == ext][0]
+        return Rendition(rendition.gallery, rendition.photo,
+                rendition.orig_node, var_width, var_height, var_quality,
+                rendition.rotation, img_format, rendition.orientation,
+                cache_dir, name)
+
+    def get_sheet_map(self, gallery, renditions, content_mtime, offset=0,
+            limit=None, columns=SHEET_COLUMNS, rows=SHEET_ROWS):
+        """
+        Return the layout of contact sheets of the given thumbnail renditions
+        of a page of the gallery (given by offset and limit): the size of
+        each sheet and where each photo's thumbnail is on which sheet.  Only
+        the rendition sizes are needed; the sheets themselves are built by
+        get_contact_sheet().  A sheet's stamp changes whenever the gallery's
+        content mtime or any of its photos change.
+        """
+        (cell_width, cell_height) = (
+                max([r.width for r in renditions] or [1]),
+                max([r.height for r in renditions] or [1]))
+        quality = max([r.quality for r in renditions] or [0])
+
+        # Keep each sheet within what a JPEG can hold.
+        columns = max(min(columns, len(renditions),
+            SHEET_MAX_DIMENSION // cell_width), 1)
+        rows = max(min(rows, SHEET_MAX_DIMENSION // cell_height), 1)
+        per_sheet = columns * rows
+
+        sheet_map = {
+                'sheets': [],
+                'tiles': {},
+        }
+        for first in range(0, len(renditions), per_sheet):
+            sheet_renditions = renditions[first:first + per_sheet]
+            index = len(sheet_map['sheets'])
+            sheet_rows = (len(sheet_renditions) + columns - 1) // columns
+            sheet_name = '%s-sheet-%d-%s-%d-%dx%d-%d' % (gallery, offset,
+                    limit or 'all', index, cell_width, cell_height, quality)
+            sheet_map['sheets'].append({
+                'name': sheet_name,
+                'first': first,
+                'count': len(sheet_renditions),
+                'quality': quality,
+                'width': columns * cell_width,
+                'height': sheet_rows * cell_height,
+                'stamp': [content_mtime,
+                    max(r.orig_node.stat.st_mtime for r in sheet_renditions),
+                    [r.photo for r in sheet_renditions]],
+            })
+            for (position, rendition) in enumerate(sheet_renditions):
+                (row, column) = divmod(position, columns)
+                sheet_map['tiles'][rendition.photo] = {
+                        'sheet': index,
+                        'x': (column * cell_width) \
+                                + ((cell_width - rendition.width) // 2),
+                        'y': (row * cell_height) \
+                                + ((cell_height - rendition.height) // 2),
+                        'width': rendition.width,
+                        'height': rendition.height,
+                }
+        return sheet_map
+
+    def get_sheet_path(self, gallery, sheet):
+        """
+        Return the path of the contact sheet described (an entry in the
+        sheets of a sheet map), if it has been built and is current;
+        otherwise None.
+        """
+        sheet_path = self._cache_node.join(gallery, '%s.jpg' % sheet['name'])
+        try:
+            stamp = self._sheets[sheet_path]
+        except KeyError:
+            map_path = self._cache_node.join(gallery,
+                    '.%s.json' % sheet['name'])
+            try:
+                with open(map_path, 'rt') as map_file:
+                    stamp = json.load(map_file)['stamp']
+            except (IOError, OSError, ValueError, KeyError):
+                return None
+
+        if (stamp != sheet['stamp']) or not os.path.exists(sheet_path):
+            self._sheets.pop(sheet_path, None)
+            return None
+        self._sheets[sheet_path] = stamp
+        return sheet_path
+
+    @coroutine
+    def get_contact_sheet(self, gallery, renditions, sheet_map, index,
+            priority=PRIORITY_THUMBNAIL):
+        """
+        Return the path of the given contact sheet of a sheet map, building
+        it from its thumbnails if it is not current.  renditions are those
+        the sheet map was made from.
+        """
+        sheet = sheet_map['sheets'][index]
+        sheet_path = self.get_sheet_path(gallery, sheet)
+        if sheet_path is None:
+            sheet_path = yield self._single_flight(FLIGHT_SHEET,
+                    self._cache_node.join(gallery, '%s.jpg' % sheet['name']),
+                    lambda : self._build_contact_sheet(gallery,
+                        renditions[sheet['first']:
+                            sheet['first'] + sheet['count']],
+                        sheet, sheet_map['tiles'], priority))
+        self._touch_file(sheet_path)
+        raise Return(sheet_path)
+
+    @coroutine
+    def _build_contact_sheet(self, gallery, renditions, sheet, positions,
+            priority):
+        # Get the sheet's thumbnails rendered first.
+        paths = yield [self.get_rendition_path(r, priority=priority)
+                for r in renditions]
+
+        sheet_path = self._cache_node.join(gallery, '%s.jpg' % sheet['name'])
+        map_path = self._cache_node.join(gallery, '.%s.json' % sheet['name'])
+        tiles = [(path, positions[r.photo]['x'], positions[r.photo]['y'])
+                for (r, path) in zip(renditions, paths)]
+
+        self._log.debug('Building %s from %d thumbnails',
+                sheet_path, len(tiles))
+        yield self._pool.apply(func=build_contact_sheet,
+                args=(sheet_path, map_path, sheet, tiles),
+                priority=priority,
+                cost=sheet['width'] * sheet['height'] * PIXEL_BYTES)
+        self._sheets[sheet_path] = sheet['stamp']
+        raise Return(sheet_path)
+
+    def get_load(self, rendition, priority=None):
+        """
+        Return the number of jobs that would be run before the rendition,
+        and an estimate of how long it would wait to be rendered.
+        """
+        return self._pool.get_load(self._get_priority(rendition, priority))
+
+    @coroutine
+    def _render_pyramid_level(self, gallery, photo, orig_node, width,
+            height, orientation, priority=PRIORITY_INTERACTIVE,
+            is_cancelled=None):
+        """
+        Render the smallest power-of-two reduction of the photo that covers
+        the size given, returning its path and size; or None if there is no
+        such reduction.  is_cancelled says whether the rendering that needs
+        it is still wanted.
+        """
+        (orig_width, orig_height) = self.get_dimensions(gallery, photo,
+                orientation=orientation)
+        level = None
+        for shift in range(1, PYRAMID_DEPTH + 1):
+            (level_width, level_height) = \
+                    (orig_width >> shift, orig_height >> shift)
+            if (level_width < width) or (level_height < height):
+                break
+            level = (level_width, level_height)
+
+        if (level is None) or (level == (width, height)):
+            return None
+
+        (level_width, level_height) = level
+        key = (gallery, photo, level_width, level_height, PYRAMID_QUALITY,
+                0.0, ImageFormat.JPEG)
+        with self._interested(key, is_cancelled):
+            cache_path = yield self._render(gallery, photo, orig_node,
+                    level_width, level_height, PYRAMID_QUALITY, 0.0,
+                    ImageFormat.JPEG, orientation, None, priority,
+                    pyramid=False)
+        self._touch_file(cache_path)
+        raise Return((cache_path, level))
 
     def _get_cache_name(self, gallery, photo, width, height, quality,
             rotation, img_format):
@@ -194,7 +991,12 @@ class ResizerPool(object):
         cache_dir = self._cache_node.join(gallery, photo_noext)
         return (cache_dir, cache_name)
 
+    @coroutine
     def _read_cache(self, orig_node, cache_dir, cache_name):
+        """
+        Read the cached file if it is current, in a worker thread; or
+        return None.
+        """
         # Do we have this file now?
         cache_path = self._cache_node.join(cache_dir, cache_name)
         try:
@@ -203,138 +1005,502 @@ class ResizerPool(object):
             if (cache_node.stat.st_size > 0) and \
                     (cache_node.stat.st_mtime >= orig_node.stat.st_mtime):
                 # This will do.  Re-use the existing file.
-                return open(cache_node.abs_path, 'rb').read()
-        except KeyError:
-            # We do not, press on!
+                data = yield IOLoop.current().run_in_executor(None,
+                        _read_file, cache_node.abs_path)
+                raise Return(data)
+        except (KeyError, OSError):
+            # We do not (or it was trimmed since), press on!
             pass
 
-    def _do_resize(self, gallery, photo, width, height, quality,
-            rotation, img_format, orientation):
+    def get_dimensions(self, gallery, photo, width=None, height=None,
+            orientation=0):
         """
-        Perform a resize of the image, and return the result.
+        Return the size of the photo once oriented, fitted to the width and
+        height given if any.  The original's size is taken from the
+        properties index.
         """
-        img_format = ImageFormat(img_format)
-        (cache_dir, cache_name) = self._get_cache_name(gallery, photo,
-                width,height, quality, rotation, img_format)
+        properties = self.get_properties(gallery, photo)
+        size = oriented_dimensions(properties['raw_width'],
+                properties['raw_height'], orientation)
 
-        log = self._log.getChild('%s/%s@%dx%d' \
-                % (gallery, photo, width, height))
-        log.debug('Resizing photo; quality %f, '\
-                'rotation %f, format %s, orientation %s; save as %s in %s',
-                quality, rotation, img_format.name, orientation,
-                cache_name, cache_dir)
+        if (width is None) and (height is None):
+            return size
 
-        # Determine the path to the original file.
-        orig_node = self._fs_node.join_node(gallery, photo)
+        return calc_dimensions(*(size + (width, height)))
 
-        # Ensure the directory exists
-        makedirs(cache_dir, exist_ok=True)
+    @property
+    def stats(self):
+        """
+        Return statistics on the resizer's operation.
+        """
+        stats = {
+                'single_flight': dict((kind, {
+                    'started': self._started[kind],
+                    'coalesced': self._coalesced[kind],
+                    'in_flight': len(self._flights[kind]),
+                }) for kind in FLIGHTS),
+                'memory_cache': self._memory_cache.stats,
+                'pool': self._pool.stats,
+                'service_time': self._pool.service_time,
+        }
+        memory_stats = self._pool.memory_stats
+        memory_stats.update({
+            'measured': self._memory_measured,
+            'peak_rss': self._memory_peak,
+            'underestimated': self._memory_underestimated,
+        })
+        stats['memory'] = memory_stats
+        if self._cache_manager is not None:
+            disk_stats = self._cache_manager.stats
+            (disk_stats['trimmed_files'], disk_stats['trimmed_size']) = \
+                    self._cache_trimmed
+            stats['disk_cache'] = disk_stats
+        return stats
 
-        # Do we have this file now?
-        data = self._read_cache(orig_node, cache_dir, cache_name)
-        if data is not None:
-            return (img_format, cache_name, data)
-
-        # Open the image
-        img = Image.open(open(orig_node.abs_path,'rb'))
-
-        # Credit: http://piexif.readthedocs.io/en/stable/sample.html
-        if orientation == 2:
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 3:
-            img = img.transpose(Image.ROTATE_180)
-        elif orientation == 4:
-            img = img.transpose(Image.ROTATE_180).transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 5:
-            img = img.transpose(Image.ROTATE_270).transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 6:
-            img = img.transpose(Image.ROTATE_270)
-        elif orientation == 7:
-            img = img.transpose(Image.ROTATE_90).transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 8:
-            img = img.transpose(Image.ROTATE_90)
-
-        # Rotate if asked:
-        if rotation != 0:
-            img = img.rotate(rotation, expand=1)
+    def _get_properties_index(self, gallery):
+        """
+        Return the properties index for the given gallery.
+        """
+        try:
+            return self._properties[gallery]
+        except KeyError:
+            index = PropertiesIndex(
+                    self._cache_node.join(gallery, PROPERTIES_FILE),
+                    log=self._log.getChild('properties'))
+            self._properties[gallery] = index
+            return index
 
-        # Resize!
-        img = img.resize((width, height), Image.LANCZOS)
+    def get_properties(self, gallery, photo):
+        """
+        Return the raw properties of the photo.  These are served from the
+        properties index; callers on the IOLoop should call fetch_properties
+        first, as a photo not yet indexed is read in the calling thread.
+        """
+        img_node = self._fs_node.join_node(gallery, photo)
+        index = self._get_properties_index(gallery)
+        stat = img_node.stat
+        properties = index.get(photo, stat)
+        if properties is None:
+            self._log.warning('%s/%s not indexed, reading properties '\
+                    'in the calling thread', gallery, photo)
+            properties = read_properties(img_node.abs_path,
+                    log=self._log.getChild('%s/%s' % (gallery, photo)))
+            index.set(photo, stat, properties)
+            IOLoop.current().add_callback(self._save_properties, gallery)
+        return properties
 
-        # Convert to RGB colourspace if not GIF
-        if img_format != ImageFormat.GIF:
-            img = img.convert('RGB')
+    @coroutine
+    def _save_properties(self, gallery):
+        """
+        Save the gallery's properties index in a worker thread.  Saves
+        requested whilst one is running wait for it, then save everything
+        added in the meantime in one pass.
+        """
+        try:
+            lock = self._properties_saving[gallery]
+        except KeyError:
+            lock = Lock()
+            self._properties_saving[gallery] = lock
 
-        # Write out the new file.
-        cache_path = self._cache_node.join(cache_dir, cache_name)
-        img.save(open(cache_path,'wb'), img_format.pil_fmt)
+        index = self._get_properties_index(gallery)
+        with (yield lock.acquire()):
+            if index.dirty:
+                yield IOLoop.current().run_in_executor(None, index.save)
 
-        # Return to caller
-        log.info('Returning resized result')
-        return (img_format, cache_name,
-                open(cache_path, 'rb').read())
+    @coroutine
+    def fetch_properties(self, gallery, photos,
+            priority=PRIORITY_INTERACTIVE):
+        """
+        Ensure the properties of the given photos are in the properties
+        index, reading those that are missing or out of date in the worker
+        pool.
+        """
+        index = self._get_properties_index(gallery)
+        pending = []
+        for photo in photos:
+            img_node = self._fs_node.join_node(gallery, photo)
+            stat = img_node.stat
+            if index.get(photo, stat) is not None:
+                continue
 
-    def get_dimensions(self, gallery, photo, width=None, height=None):
-        img_node = self._fs_node.join_node(gallery, photo)
-        img = Image.open(open(img_node.abs_path,'rb'))
+            key = (gallery, photo)
+            try:
+                future = self._properties_pending[key]
+            except KeyError:
+                future = self._pool.apply(func=read_properties,
+                        args=(img_node.abs_path,), priority=priority)
+                self._properties_pending[key] = future
+            pending.append((photo, stat, future))
 
-        if (width is None) and (height is None):
-            return img.size
+        if not pending:
+            return
 
-        return calc_dimensions(*(img.size + (width, height)))
+        self._log.debug('%s: reading properties of %d photos',
+                gallery, len(pending))
+        for (photo, stat, future) in pending:
+            try:
+                properties = yield future
+            except:
+                self._log.exception('Failed to read properties; '\
+                        'gallery: %s, photo: %s', gallery, photo)
+                continue
+            finally:
+                self._properties_pending.pop((gallery, photo), None)
+            index.set(photo, stat, properties)
+        yield self._save_properties(gallery)
 
-    def get_properties(self, gallery, photo):
-        """
-        Return the raw properties of the photo.
-        """
-        log = self._log.getChild('%s/%s' % (gallery, photo))
-        img_node = self._fs_node.join_node(gallery, photo)
-        (width, height) = self.get_dimensions(gallery, photo)
-        meta = dict(width=width, height=height)
 
-        log.debug('Raw dimensions %dx%d', width, height)
+def _strip_blobs(obj):
+    """
+    Decode the EXIF data, stripping the blobs.  This is an ugly workaround to
+    https://github.com/hMatoba/Piexif/issues/58
+    """
+    if isinstance(obj, bytes):
+        return obj.decode('UTF-8')
+    if isinstance(obj, dict):
+        out = {}
+        for key, value in obj.items():
+            try:
+                out[key] = _strip_blobs(value)
+            except:
+                pass
+        return out
+    if isinstance(obj, list) or isinstance(obj, tuple):
+        out = []
+        for value in obj:
+            try:
+                out.append(_strip_blobs(value))
+            except:
+                pass
+        return out
+    return obj
+
+
+def read_properties(path, log=None):
+    """
+    Read the raw properties of the photo at the given path.  This opens the
+    original file, so is intended to be run in a worker.
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
+        mime_type = m.id_filename(path)
+    log.debug('Detected format %s', mime_type)
+
+    with Image.open(path) as img:
+        (width, height) = img.size
+        alpha = _has_alpha(img)
+    meta = dict(width=width, height=height,
+            raw_width=width, raw_height=height, mime_type=mime_type,
+            alpha=alpha)
+
+    log.debug('Raw dimensions %dx%d', width, height)
+
+    try:
+        exif = piexif.load(path, key_is_name=True)
+        log.debug('Loaded EXIF data')
+    except:
+        # Maybe EXIF is not supported?  Or maybe piexif isn't loaded.
+        exif = None
+        log.debug('No EXIF data available', exc_info=1)
+
+    if exif is not None:
+        # Trim the embedded thumbnail and maker notes, these are large
+        # binary blobs of no use to us.
+        exif.pop('thumbnail', None)
+        exif.get('Exif', {}).pop('MakerNote', None)
+        meta['exif'] = _strip_blobs(exif)
 
         try:
-            exif = piexif.load(img_node.abs_path,
-                    key_is_name=True)
-            log.debug('Loaded EXIF data')
-        except:
-            # Maybe EXIF is not supported?  Or maybe piexif isn't loaded.
-            exif = None
-            log.debug('No EXIF data available', exc_info=1)
-
-        if exif is not None:
-            # Decode the EXIF data¸ stripping the blobs
-            # This is an ugly workaround to
-            # https://github.com/hMatoba/Piexif/issues/58
-            def _strip_blobs(obj):
-                if isinstance(obj, bytes):
-                    return obj.decode('UTF-8')
-                if isinstance(obj, dict):
-                    out = {}
-                    for key, value in obj.items():
-                        try:
-                            out[key] = _strip_blobs(value)
-                        except:
-                            pass
-                    return out
-                if isinstance(obj, list) or isinstance(obj, tuple):
-                    out = []
-                    for value in obj:
-                        try:
-                            out.append(_strip_blobs(value))
-                        except:
-                            pass
-                    return out
-                return obj
-            meta['exif'] = _strip_blobs(exif)
+            if meta['exif']['0th']['Orientation'] in (5, 6, 7, 8):
+                log.debug('Swapping width/height due to orientation')
+                meta['height'] = width
+                meta['width'] = height
+        except KeyError:
+            pass
+
+    return meta
+
+
+def _has_alpha(img):
+    """
+    Return whether the image has an alpha channel or transparent colour.
+    """
+    return (img.mode in ('RGBA', 'LA', 'PA')) or ('transparency' in img.info)
+
 
+def _to_gif_palette(img):
+    """
+    Reduce an RGBA image to a 255 colour palette, with the last index for
+    transparent pixels; returning the image and its transparency index.
+    """
+    transparency = 255
+    mask = img.getchannel('A').point(
+            lambda a : 255 if a < GIF_ALPHA_THRESHOLD else 0)
+    img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE,
+            colors=transparency)
+    img.paste(transparency, mask=mask)
+    return (img, transparency)
+
+
+def _read_file(path):
+    """
+    Read the whole of the given file.
+    """
+    with open(path, 'rb') as data_file:
+        return data_file.read()
+
+
+def _is_cached(orig_path, cache_path):
+    """
+    Return true if the cache file exists, is non-empty and no older than the
+    original.
+    """
+    try:
+        cache_stat = stat(cache_path)
+    except OSError:
+        return False
+    return (cache_stat.st_size > 0) and \
+            (cache_stat.st_mtime >= stat(orig_path).st_mtime)
+
+
+@contextmanager
+def _cache_lock(cache_dir, cache_name):
+    """
+    Hold an exclusive lock on the named cache file, shared with any other
+    process using the same cache directory.  The lock file is removed
+    afterwards; if it is removed whilst we wait, we lock the new one.
+    """
+    lock_path = os.path.join(cache_dir, '.%s.lock' % cache_name)
+    while True:
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
             try:
-                if meta['exif']['0th']['Orientation'] in (5, 6, 7, 8):
-                    log.debug('Swapping width/height due to orientation')
-                    meta['height'] = width
-                    meta['width'] = height
-            except KeyError:
+                if os.fstat(lock_fd).st_ino == os.stat(lock_path).st_ino:
+                    break
+            except OSError:
+                # Removed by the previous holder
                 pass
+        except:
+            os.close(lock_fd)
+            raise
+        os.close(lock_fd)
+
+    try:
+        yield
+    finally:
+        try:
+            os.unlink(lock_path)
+        except OSError:
+            pass
+        os.close(lock_fd)
+
+
+def resize_photo(orig_path, cache_dir, cache_name, width, height, quality,
+        rotation, img_format, orientation, fast_ratio=None):
+    """
+    Perform a resize of the image, writing the result to the cache.  Returns
+    the path to the cached file.  This is run in a worker, so only takes and
+    returns picklable values.
+
+    If the image is being shrunk by at least fast_ratio, the image is
+    decoded at reduced scale where the format allows it (JPEG) and reduced
+    by an integer factor before the final resampling.
+
+    Only one process renders a given file at a time; others wait for it
+    and use its result.  The file is written under a temporary name then
+    moved into place, so it is never seen incomplete.
+    """
+    img_format = ImageFormat(img_format)
+    cache_path = os.path.join(cache_dir, cache_name)
+
+    log = logging.getLogger(__name__).getChild('%s@%dx%d' \
+            % (os.path.basename(orig_path), width, height))
+    log.debug('Resizing photo; quality %f, '\
+            'rotation %f, format %s, orientation %s; save as %s in %s',
+            quality, rotation, img_format.name, orientation,
+            cache_name, cache_dir)
+
+    # Ensure the directory exists
+    makedirs(cache_dir, exist_ok=True)
+
+    # Do we have this file now?
+    if _is_cached(orig_path, cache_path):
+        return cache_path
+
+    with _cache_lock(cache_dir, cache_name):
+        # Did another process render it whilst we waited?
+        if _is_cached(orig_path, cache_path):
+            log.debug('Rendered by another process')
+            return cache_path
+
+        _resize_photo(orig_path, cache_path, width, height, quality,
+                rotation, img_format, orientation, fast_ratio, log)
+    return cache_path
+
+
+def _resize_photo(orig_path, cache_path, width, height, quality,
+        rotation, img_format, orientation, fast_ratio, log):
+    """
+    Resize the image and write it to the given cache path.
+    """
+    # Open the image
+    img = Image.open(orig_path)
+
+    # Work out the geometry up front, so that we can shrink the image first
+    # and do the orientation and rotation on the smaller result.
+    (raw_width, raw_height) = img.size
+    (oriented_width, oriented_height) = oriented_dimensions(
+            raw_width, raw_height, orientation)
+    (rotated_width, rotated_height) = rotated_dimensions(
+            oriented_width, oriented_height, rotation)
+    scale = max(float(width) / rotated_width,
+            float(height) / rotated_height)
+
+    if not (rotation % 90.0):
+        # Right-angle rotations just swap the axes, so we can go straight
+        # to the final size.
+        (scaled_width, scaled_height) = oriented_dimensions(
+                width, height, orientation)
+        if rotation % 180.0:
+            (scaled_width, scaled_height) = (scaled_height, scaled_width)
+    elif scale < 1.0:
+        # Shrink as far as we can without going below the target size once
+        # rotated.
+        scaled_width = max(1, int(round(raw_width * scale)))
+        scaled_height = max(1, int(round(raw_height * scale)))
+    else:
+        # Enlarging, do this as part of the rotation.
+        (scaled_width, scaled_height) = (raw_width, raw_height)
+
+    reducing_gap = None
+    if fast_ratio and (scale * fast_ratio <= 1.0):
+        # Ask the decoder for no less than what we need; for JPEG, libjpeg
+        # will decode at 1/2, 1/4 or 1/8 scale.
+        img.draft(img.mode, (int(ceil(raw_width * scale)),
+            int(ceil(raw_height * scale))))
+        reducing_gap = FAST_REDUCING_GAP
+        log.debug('Fast downscale by %f; decoded at %s', scale, img.size)
+
+    # Work in RGBA if there is transparency to keep, so it survives
+    # resampling and rotation.
+    if _has_alpha(img) and (img.mode != 'RGBA'):
+        img = img.convert('RGBA')
+
+    # Resize!
+    if img.size != (scaled_width, scaled_height):
+        img = img.resize((scaled_width, scaled_height), Image.LANCZOS,
+                reducing_gap=reducing_gap)
+
+    # Apply the EXIF orientation; each is a single transposition.
+    # Credit: http://piexif.readthedocs.io/en/stable/sample.html
+    try:
+        img = img.transpose(_ORIENTATION_TRANSPOSE[orientation])
+    except KeyError:
+        pass
+
+    # Rotate if asked:
+    if not (rotation % 90.0):
+        if rotation % 360.0:
+            img = img.rotate(rotation, expand=1)
+    else:
+        img = _rotate_to(img, rotation, (width, height))
+
+    # Correct any rounding error
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.LANCZOS)
+
+    # Convert to a colourspace the format can hold, keeping any
+    # transparency where the format allows it.
+    save_args = {}
+    if img_format == ImageFormat.GIF:
+        if img.mode == 'RGBA':
+            (img, save_args['transparency']) = _to_gif_palette(img)
+    elif (img_format != ImageFormat.PNG) or (img.mode != 'RGBA'):
+        img = img.convert('RGB')
+
+    # Write out the new file, then move it into place.
+    _write_cache_file(cache_path,
+            lambda cache_file : img.save(cache_file, img_format.pil_fmt,
+                **save_args))
+
+    log.info('Resized result written')
+
+
+def _write_cache_file(cache_path, write, mode='wb'):
+    """
+    Write a cache file with the given function, under a temporary name that
+    is then moved into place so that readers never see it incomplete.
+    """
+    (cache_dir, cache_name) = os.path.split(cache_path)
+    temp_path = os.path.join(cache_dir,
+            '.%s.%s.tmp' % (cache_name, uuid4().hex))
+    try:
+        with open(temp_path, mode) as cache_file:
+            write(cache_file)
+        os.rename(temp_path, cache_path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def build_contact_sheet(sheet_path, map_path, sheet_info, tiles):
+    """
+    Paste the thumbnails given as (path, x, y) into a contact sheet of the
+    size and quality given in the sheet info, then write out the sheet and
+    its info.
+    """
+    log = logging.getLogger('%s.sheet' % __name__)
+    sheet = Image.new('RGB', (sheet_info['width'], sheet_info['height']),
+            (255, 255, 255))
+    for (tile_path, x, y) in tiles:
+        with Image.open(tile_path) as tile:
+            sheet.paste(tile.convert('RGB'), (x, y))
+
+    _write_cache_file(sheet_path,
+            lambda sheet_file : sheet.save(sheet_file, 'JPEG',
+                quality=int(sheet_info['quality'])))
+    _write_cache_file(map_path,
+            lambda map_file : json.dump(sheet_info, map_file), mode='wt')
+    log.info('Wrote %d thumbnails to %s', len(tiles), sheet_path)
+    return sheet_path
+
+
+def _read_memory_status():
+    """
+    Return the current and peak resident set size of this process in bytes,
+    from /proc/self/status (Linux).
+    """
+    values = {}
+    with open('/proc/self/status', 'rt') as status:
+        for line in status:
+            (name, _, value) = line.partition(':')
+            if name in ('VmRSS', 'VmHWM'):
+                values[name] = int(value.split()[0]) * 1024
+    return (values['VmRSS'], values['VmHWM'])
+
+
+def resize_photo_measured(*args):
+    """
+    As resize_photo, but also returns how far the worker's resident set
+    grew whilst resizing, in bytes; or None where this cannot be measured.
+    """
+    try:
+        # Reset the peak to the current size
+        with open('/proc/self/clear_refs', 'wt') as clear_refs:
+            clear_refs.write('5')
+        (base_rss, _) = _read_memory_status()
+    except (IOError, OSError, KeyError):
+        base_rss = None
+
+    cache_path = resize_photo(*args)
+    if base_rss is None:
+        return (cache_path, None)
 
-        return meta
+    (_, peak_rss) = _read_memory_status()
+    return (cache_path, max(peak_rss - base_rss, 0))
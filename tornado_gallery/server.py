@@ -4,22 +4,118 @@ import argparse
 import logging
 import uuid
 import datetime
+import email.utils
+import gzip
 import json
+import os
 import os.path
+import sys
+from hashlib import sha1
+from urllib.parse import parse_qsl, urlencode
+from math import ceil
+from multiprocessing import cpu_count
 
 
 from tornado.web import Application, RequestHandler, \
         RedirectHandler, MissingArgumentError, StaticFileHandler
 from tornado.httpclient import AsyncHTTPClient, HTTPError
 from tornado.httpserver import HTTPServer
-from tornado.locks import Semaphore
-from tornado.gen import coroutine, TimeoutError
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+from tornado.locks import Semaphore, Event
+from tornado.gen import coroutine, Return, TimeoutError
 from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 
 
 from .gallery import GalleryCollection, CACHE_DIR_NAME
+from .cache import LRUCache
+from . import diskcache, warm
+from .jobs import JobManager, DEFAULT_JOB_CONCURRENCY
+from .admission import AdmissionController
+from .ladder import SizeLadder, LADDER_REDIRECT, LADDER_SERVE, \
+        LADDER_MODES, parse_steps, uri_form
+from .pool import BACKEND_PROCESS, BACKENDS, DEFAULT_AGING, \
+        PRIORITY_INTERACTIVE, PRIORITY_THUMBNAIL, JobCancelled
+from .resizer import DEFAULT_FAST_DOWNSCALE_RATIO, \
+        DEFAULT_MEMORY_CACHE_SIZE
 from .photo import DEFAULT_WIDTH, DEFAULT_HEIGHT, \
-        DEFAULT_QUALITY, DEFAULT_ROTATION
+        DEFAULT_QUALITY, DEFAULT_ROTATION, THUMB_SIZE, THUMB_QUALITY, \
+        THUMB_FORMAT
+
+# Delivery modes for resized images
+DELIVERY_MEMORY = 'memory'
+DELIVERY_STREAM = 'stream'
+DELIVERY_X_ACCEL = 'x-accel-redirect'
+DELIVERY_X_SENDFILE = 'x-sendfile'
+DELIVERY_MODES = (DELIVERY_MEMORY, DELIVERY_STREAM,
+        DELIVERY_X_ACCEL, DELIVERY_X_SENDFILE)
+
+# Size of chunks when streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# How often to send something on an idle event stream, in seconds
+EVENT_KEEPALIVE = 15.0
+
+# Photos shown per gallery page by default, and the most that may be asked
+# for at once
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Photos written between flushes of a batch metadata response
+META_BATCH_CHUNK = 50
+
+# Memory for serialised metadata responses, in bytes
+META_CACHE_SIZE = 4 * 1024 * 1024
+
+# Query arguments that affect a photo's metadata response
+VIEW_ARGS = ('width', 'height', 'quality', 'rotation', 'format')
+
+
+def get_page_range(handler, limit=None):
+    """
+    Return the offset and limit of the page of photos requested.  limit is
+    the page size if the request doesn't give one.  A limit given by the
+    client is always bounded to 1..MAX_PAGE_SIZE.
+    """
+    try:
+        offset = max(int(handler.get_query_argument('offset', 0)), 0)
+    except ValueError:
+        offset = 0
+    try:
+        limit = min(max(int(handler.get_query_argument('limit')), 1),
+                MAX_PAGE_SIZE)
+    except (MissingArgumentError, ValueError):
+        pass
+    return (offset, limit)
+
+
+def get_view_args(handler, photo):
+    """
+    Return the view width, height, quality, rotation and format requested
+    for a photo.  The view defaults to the photo's own size, up to
+    DEFAULT_WIDTH by DEFAULT_HEIGHT; an empty width or height leaves it
+    unbounded.
+    """
+    width=handler.get_query_argument('width',
+            min(photo.width, DEFAULT_WIDTH))
+    height=handler.get_query_argument('height',
+            min(photo.height, DEFAULT_HEIGHT))
+
+    if width:
+        width = int(width)
+    else:
+        width = None
+
+    if height:
+        height = int(height)
+    else:
+        height = None
+
+    return (width, height,
+            float(handler.get_query_argument('quality', DEFAULT_QUALITY)),
+            float(handler.get_query_argument('rotation', DEFAULT_ROTATION)),
+            handler.get_query_argument('format', None))
 
 
 class DebugHandler(RequestHandler):
@@ -50,6 +146,22 @@ Body:
 ))
 
 
+class StatsHandler(RequestHandler):
+    def get(self):
+        self.set_status(200)
+        self.set_header('Content-Type', 'application/json')
+        stats = self.application._collection.stats
+        stats['jobs'] = self.application._jobs.stats
+        stats['meta_cache'] = self.application._meta_cache.stats
+        if self.application._admission is not None:
+            stats['admission'] = self.application._admission.stats
+        stats['process'] = {
+                'task_id': self.application._task_id,
+                'pid': os.getpid(),
+        }
+        self.write(json.dumps(stats))
+
+
 class RootHandler(RequestHandler):
     def get(self):
         self.set_status(200)
@@ -64,11 +176,14 @@ class RootHandler(RequestHandler):
 
 
 class GalleryHandler(RequestHandler):
+    @coroutine
     def get(self, gallery_name):
         gallery = self.application._collection[gallery_name]
 
         self.set_status(200)
         if bool(self.get_query_argument('generate', False)):
+            # Render in the background; the page just shows progress.
+            self.application._jobs.start(gallery.name)
             self.render('generator.thtml',
                     static_uri=self.application._static_uri,
                     site_uri=self.application._site_uri,
@@ -77,6 +192,32 @@ class GalleryHandler(RequestHandler):
             )
             return
 
+        (offset, limit) = get_page_range(self, self.application._page_size)
+        photos = gallery.get_page(offset, limit)
+
+        # Index the photo properties up front, rather than one at a time
+        # whilst rendering.
+        yield gallery.load_properties([photo.name for photo in photos])
+
+        # The sheets are laid out from the thumbnail sizes alone; they are
+        # only built once the browser asks for them.
+        sheet = None
+        if self.application._contact_sheet:
+            sheet = self.application.get_sheet_info(gallery,
+                    gallery.get_sheet_map(self.application.get_thumbnails(
+                        photos), offset, limit), offset, limit)
+
+        total = len(gallery)
+        page = {
+                'offset': offset,
+                'limit': limit,
+                'total': total,
+                'prev_uri': self._get_page_uri(max(offset - limit, 0)) \
+                        if limit and offset else None,
+                'next_uri': self._get_page_uri(offset + limit) \
+                        if limit and (offset + limit < total) else None,
+        }
+
         self.render('gallery.thtml',
                 site_name=self.application._site_name or \
                         '%s Galleries' % (self.request.host),
@@ -84,44 +225,226 @@ class GalleryHandler(RequestHandler):
                 site_uri=self.application._site_uri,
                 page_query=self.request.query,
                 gallery=gallery,
-                photos=list(gallery.values())
+                photos=photos,
+                page=page,
+                infinite_scroll=self.application._infinite_scroll,
+                thumb_uri=self.application.thumbnail_uri,
+                sheet=sheet
         )
 
+    def _get_page_uri(self, offset):
+        """
+        Return the URI of this gallery page starting at the given offset.
+        """
+        query = dict(parse_qsl(self.request.query))
+        query['offset'] = offset
+        return '%s?%s' % (self.request.path, urlencode(query))
+
+
+@coroutine
+def send_cached_json(handler, key, stamp, build):
+    """
+    Send a JSON response, serialised (and compressed) only once for the
+    given key and stamp; the stamp holds the modification times of the
+    files the response is derived from.  build is a coroutine returning
+    the object to send.  Clients that already have it are sent
+    304 Not Modified.
+    """
+    application = handler.application
+    compress = application.settings.get('compress_response') and \
+            ('gzip' in handler.request.headers.get('Accept-Encoding', ''))
+
+    # Each encoding is a different representation, so has its own tag.
+    handler.set_header('Content-Type', 'application/json')
+    handler.set_header('Etag', '"%s%s"' % (sha1(json.dumps([key, stamp])\
+            .encode('UTF-8')).hexdigest(), '-gzip' if compress else ''))
+    if not application.settings.get('compress_response'):
+        # Otherwise, tornado's gzip transform adds this.
+        handler.set_header('Vary', 'Accept-Encoding')
+    if handler.check_etag_header():
+        handler.set_status(304)
+        return
+
+    body = None
+    if compress:
+        body = application._meta_cache.get(key + ('gzip',), stamp)
+        if body is not None:
+            handler.set_header('Content-Encoding', 'gzip')
+
+    if body is None:
+        body = application._meta_cache.get(key, stamp)
+        if body is None:
+            body = json.dumps((yield build())).encode('UTF-8')
+            application._meta_cache.put(key, stamp, body)
+        if compress:
+            body = gzip.compress(body)
+            application._meta_cache.put(key + ('gzip',), stamp, body)
+            handler.set_header('Content-Encoding', 'gzip')
+
+    handler.set_status(200)
+    handler.write(body)
+
 
 class GalleryMetaHandler(RequestHandler):
     @coroutine
     def get(self, gallery_name):
         gallery = self.application._collection[gallery_name]
 
+        # Photos are only listed a page at a time.
+        thumbnails = bool(self.get_query_argument('thumbnails', False))
+        (offset, limit) = get_page_range(self,
+                self.application._page_size or MAX_PAGE_SIZE)
+        stamp = gallery.meta_mtimes
+        if thumbnails:
+            photos = gallery.get_page(offset, limit)
+            stamp += tuple(photo.meta_mtimes for photo in photos)
+
+        @coroutine
+        def build():
+            meta = gallery.get_meta(offset, limit)
+            if thumbnails:
+                yield gallery.load_properties(
+                        [photo.name for photo in photos])
+                meta['thumbnails'] = [{
+                        'name': photo.name,
+                        'title': photo.annotation or photo.name,
+                        'uri': self.application.thumbnail_uri(photo),
+                        'page_uri': '%s/%s/%s/photo.html' % (
+                            self.application._site_uri, gallery.name,
+                            photo.name),
+                        'width': photo.thumbwidth,
+                        'height': photo.thumbheight,
+                    } for photo in photos]
+            raise Return(meta)
+
+        yield send_cached_json(self,
+                ('gallery', gallery.name, offset, limit, thumbnails),
+                stamp, build)
+
+
+class SheetHandler(RequestHandler):
+    @coroutine
+    def get(self, gallery_name, ext):
+        gallery = self.application._collection[gallery_name]
+        (offset, limit) = get_page_range(self, self.application._page_size)
+        photos = gallery.get_page(offset, limit)
+        yield gallery.load_properties([photo.name for photo in photos])
+        renditions = self.application.get_thumbnails(photos)
+        sheet_map = gallery.get_sheet_map(renditions, offset, limit)
+        sheet_info = self.application.get_sheet_info(gallery, sheet_map,
+                offset, limit)
+
+        if ext == 'json':
+            self.set_status(200)
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(sheet_info))
+            return
+
+        try:
+            index = int(self.get_query_argument('sheet', 0))
+            if index < 0:
+                raise IndexError(index)
+            sheet = sheet_map['sheets'][index]
+        except (ValueError, IndexError):
+            self.set_status(404)
+            return
+
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Etag',
+                '"%s"' % sheet_info['sheets'][index]['version'])
+        max_age = self.application._image_max_age
+        if max_age is not None:
+            self.set_header('Cache-Control', 'public, max-age=%d' % max_age)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        # Building a sheet may mean rendering all its thumbnails; may we?
+        sheet_path = gallery.get_sheet_path(sheet)
+        if sheet_path is None:
+            admission = self.application._admission
+            if admission is not None:
+                (queued, wait) = gallery.get_load(None, PRIORITY_THUMBNAIL)
+                refusal = admission.admit(self.request.remote_ip,
+                        queued, wait)
+                if refusal is not None:
+                    (status, retry_after) = refusal
+                    self.clear_header('Etag')
+                    self.set_status(status)
+                    self.set_header('Retry-After', int(ceil(retry_after)))
+                    return
+            sheet_path = yield gallery.get_contact_sheet(renditions,
+                    sheet_map, index)
+
+        self.set_status(200)
+        with open(sheet_path, 'rb') as sheet_file:
+            self.write(sheet_file.read())
+
+
+class JobHandler(RequestHandler):
+    def get(self, gallery_name):
+        try:
+            job = self.application._jobs[gallery_name]
+        except KeyError:
+            self.set_status(404)
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'gallery': gallery_name, 'state': None}))
+            return
+
         self.set_status(200)
         self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps(gallery.meta))
+        self.write(json.dumps(job.status))
 
+    def post(self, gallery_name):
+        job = self.application._jobs.start(gallery_name)
+        self.set_status(202)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(job.status))
 
-class ThumbnailHandler(RequestHandler):
-    def get(self, gallery_name, photo_name):
-        gallery = self.application._collection[gallery_name]
-        photo = gallery[photo_name]
 
-        self.redirect(
-                ('%(site)s/%(gallery)s/%(photo)s/%(width)dx%(height)d'\
-                 '@%(rotation)f/%(quality)d/jpeg') % {
-                     'site': self.application._site_uri,
-                     'gallery': gallery.name,
-                     'photo': photo.name,
-                     'width': photo.thumbwidth,
-                     'height': photo.thumbheight,
-                     'rotation': 0,
-                     'quality': 25,
-                 })
+class JobEventsHandler(RequestHandler):
+    @coroutine
+    def get(self, gallery_name):
+        try:
+            job = self.application._jobs[gallery_name]
+        except KeyError:
+            self.set_status(404)
+            return
+
+        self.set_status(200)
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        # Ask nginx not to buffer the stream
+        self.set_header('X-Accel-Buffering', 'no')
+        try:
+            while True:
+                self.write('data: %s\n\n' % json.dumps(job.status))
+                yield self.flush()
+                if job.finished:
+                    break
+                yield job.wait(EVENT_KEEPALIVE)
+        except StreamClosedError:
+            # Viewer went away; the job carries on.
+            pass
 
 
 class PhotoHandler(RequestHandler):
+    # Whether the URI names a fixed rendition, so may be marked immutable
+    FIXED_URI = True
+
+    def initialize(self):
+        # Set if the client goes away, to withdraw our queued rendering
+        self._cancel = Event()
+
+    def on_connection_close(self):
+        self._cancel.set()
+
     @coroutine
     def get(self, gallery_name, photo_name, width=None, height=None, rotation=None,
             quality=None, img_format=None):
         gallery = self.application._collection[gallery_name]
         photo = gallery[photo_name]
+        yield photo.load_properties()
 
         if (width is not None) and (width != '-'):
             width = int(width or 0)
@@ -133,21 +456,172 @@ class PhotoHandler(RequestHandler):
         else:
             height = None
 
-        (width, height) = photo.get_fit_size(width, height)
+        quality = float(quality or 60.0)
+        rotation = float(rotation or 0.0)
 
         if img_format is not None:
             img_format = 'image/%s' % img_format
 
-        (img_format, cache_name, img_data) = \
-                yield photo.get_resized(
+        # Bring the request onto the size ladder, if configured.
+        canonical = self.application.snap_rendition(
+                width, height, quality, rotation)
+        if uri_form(*canonical) != \
+                uri_form(width, height, quality, rotation):
+            if self.application._ladder_mode == LADDER_REDIRECT:
+                (width, height, quality, rotation) = canonical
+                self.redirect('%s/%s' % (self.application._site_uri,
+                    photo.get_rel_uri(width, height, rotation, quality,
+                        img_format)))
+                return
+            (width, height, quality, rotation) = canonical
+
+        (width, height) = photo.get_fit_size(width, height)
+
+        rendition = photo.get_rendition(
                         width=width,
                         height=height,
-                        quality=float(quality or 60.0),
-                        rotation=float(rotation or 0.0),
+                        quality=quality,
+                        rotation=rotation,
                         img_format=img_format)
+        yield self._serve(photo, rendition)
+
+    @coroutine
+    def _serve(self, photo, rendition):
+        """
+        Send the rendition of the photo, if we may render it or it is cached.
+        """
+        # If it needs rendering, may we queue it?
+        degraded = False
+        admission = self.application._admission
+        if (admission is not None) and \
+                (photo.get_cache_stat(rendition) is None):
+            (queued, wait) = photo.get_load(rendition)
+            refusal = admission.admit(self.request.remote_ip, queued, wait)
+            if refusal is not None:
+                fallback = photo.get_fallback(rendition) \
+                        if self.application._overload_fallback else None
+                if fallback is not None:
+                    admission.note_fallback()
+                    rendition = fallback
+                    degraded = True
+                else:
+                    (status, retry_after) = refusal
+                    self.set_status(status)
+                    self.set_header('Retry-After', int(ceil(retry_after)))
+                    return
+
+        try:
+            yield self._send_rendition(photo, rendition, degraded)
+        except JobCancelled:
+            # The client went away before we got to it.
+            pass
+
+    @coroutine
+    def _send_rendition(self, photo, rendition, degraded=False):
+        """
+        Send the rendition of the photo, or a 304 response if the client's
+        copy is current.  A degraded rendition, sent in place of the one
+        asked for, is marked as not to be cached.
+        """
+        self.set_header('Content-Type', rendition.img_format.value)
+        self.set_header('Etag', rendition.etag)
+
+        max_age = self.application._image_max_age
+        if degraded:
+            self.set_header('Cache-Control', 'no-store')
+        elif max_age is not None:
+            self.set_header('Cache-Control', 'public, max-age=%d%s' % (
+                max_age,
+                ', immutable' if self.FIXED_URI \
+                        and self.application._image_immutable else ''))
+
+        cache_stat = photo.get_cache_stat(rendition)
+        if cache_stat is not None:
+            self.set_header('Last-Modified',
+                    datetime.datetime.utcfromtimestamp(cache_stat.st_mtime))
+
+        if self._is_not_modified(cache_stat):
+            self.set_status(304)
+            return
+
+        delivery = self.application._delivery
+        if delivery == DELIVERY_MEMORY:
+            img_data = yield photo.get_rendition_data(rendition,
+                    cancel=self._cancel)
+        else:
+            cache_path = yield photo.get_rendition_path(rendition,
+                    cancel=self._cancel)
+
+        if cache_stat is None:
+            # Freshly rendered
+            cache_stat = photo.get_cache_stat(rendition)
+            if cache_stat is not None:
+                self.set_header('Last-Modified',
+                        datetime.datetime.utcfromtimestamp(
+                            cache_stat.st_mtime))
+
         self.set_status(200)
-        self.set_header('Content-Type', img_format.value)
-        self.write(img_data)
+        if delivery == DELIVERY_MEMORY:
+            self.write(img_data)
+        elif delivery == DELIVERY_STREAM:
+            yield self._stream_file(cache_path)
+        elif delivery == DELIVERY_X_ACCEL:
+            # Have the front-end server send the file
+            self.set_header('X-Accel-Redirect', '%s/%s' % (
+                self.application._accel_prefix,
+                os.path.relpath(cache_path,
+                    self.application._collection.cache_dir)))
+        elif delivery == DELIVERY_X_SENDFILE:
+            self.set_header('X-Sendfile', cache_path)
+
+    @coroutine
+    def _stream_file(self, path):
+        """
+        Send the file in chunks, waiting for each to be sent before reading
+        the next.
+        """
+        with open(path, 'rb') as img_file:
+            self.set_header('Content-Length',
+                    os.fstat(img_file.fileno()).st_size)
+            while True:
+                chunk = img_file.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.write(chunk)
+                yield self.flush()
+
+    def _is_not_modified(self, cache_stat):
+        """
+        Check the request's validators against our Etag and Last-Modified.
+        """
+        if self.request.headers.get('If-None-Match'):
+            # This takes precedence over If-Modified-Since
+            return self.check_etag_header()
+
+        if_since = self.request.headers.get('If-Modified-Since')
+        if (not if_since) or (cache_stat is None):
+            return False
+
+        date_tuple = email.utils.parsedate(if_since)
+        if date_tuple is None:
+            return False
+
+        return datetime.datetime(*date_tuple[:6]) >= \
+                datetime.datetime.utcfromtimestamp(int(cache_stat.st_mtime))
+
+
+class ThumbnailHandler(PhotoHandler):
+    # The thumbnail's size may change with the photo
+    FIXED_URI = False
+
+    @coroutine
+    def get(self, gallery_name, photo_name):
+        gallery = self.application._collection[gallery_name]
+        photo = gallery[photo_name]
+        yield photo.load_properties()
+
+        rendition = self.application.get_thumbnail(photo)
+        yield self._serve(photo, rendition)
 
 
 class PhotoMetaHandler(RequestHandler):
@@ -156,45 +630,51 @@ class PhotoMetaHandler(RequestHandler):
         gallery = self.application._collection[gallery_name]
         photo = gallery[photo_name]
 
-        # Figure out view width/height
-        width=self.get_query_argument('width',
-                min(photo.width, DEFAULT_WIDTH))
-        height=self.get_query_argument('height',
-                min(photo.height, DEFAULT_HEIGHT))
+        @coroutine
+        def build():
+            yield photo.load_properties()
+            meta = self.application.get_photo_meta(photo,
+                    *get_view_args(self, photo))
+            meta['gallery'] = gallery.name
+            raise Return(meta)
 
-        if width:
-            width = int(width)
-        else:
-            width = None
+        yield send_cached_json(self,
+                ('photo', gallery.name, photo.name) + tuple(
+                    self.get_query_argument(arg, None) for arg in VIEW_ARGS),
+                gallery.meta_mtimes + photo.meta_mtimes, build)
 
-        if height:
-            height = int(height)
-        else:
-            height = None
 
-        (img_width, img_height) = photo.get_fit_size(width, height)
+class PhotoBatchMetaHandler(RequestHandler):
+    @coroutine
+    def get(self, gallery_name):
+        gallery = self.application._collection[gallery_name]
+
+        # Either the photos named, or a page of the gallery.
+        names = self.get_query_arguments('photo')[:MAX_PAGE_SIZE]
+        if names:
+            photos = [gallery[name] for name in names if name in gallery]
+            offset = None
+        else:
+            (offset, limit) = get_page_range(self,
+                    self.application._page_size or MAX_PAGE_SIZE)
+            photos = gallery.get_page(offset, limit)
+        yield gallery.load_properties([photo.name for photo in photos])
 
         self.set_status(200)
         self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps({
-            'gallery': gallery.name,
-            'photo': photo.meta,
-            'src': self.application._site_uri + '/' + photo.get_rel_uri(
-                img_width, img_height,
-                             float(self.get_query_argument(
-                                'rotation', DEFAULT_ROTATION)),
-                             float(self.get_query_argument(
-                                'quality', DEFAULT_QUALITY)),
-                             self.get_query_argument('format', None)),
-            'user_size': {
-                'width': width,
-                'height': height,
-            },
-            'view_size': {
-                'width': img_width,
-                'height': img_height
-            }
-        }))
+        self.write('{"gallery": %s, "offset": %s, "total": %d, "photos": ['
+                % (json.dumps(gallery.name), json.dumps(offset),
+                    len(gallery)))
+        try:
+            for (idx, photo) in enumerate(photos):
+                self.write('%s%s' % (',' if idx else '',
+                    json.dumps(self.application.get_photo_meta(photo,
+                        *get_view_args(self, photo)))))
+                if not ((idx + 1) % META_BATCH_CHUNK):
+                    yield self.flush()
+            self.write(']}')
+        except StreamClosedError:
+            pass
 
 
 class PhotoPageHandler(RequestHandler):
@@ -202,6 +682,7 @@ class PhotoPageHandler(RequestHandler):
     def get(self, gallery_name, photo_name):
         gallery = self.application._collection[gallery_name]
         photo = gallery[photo_name]
+        yield photo.load_properties()
 
         # Figure out view width/height
         width=self.get_query_argument('width',
@@ -223,15 +704,18 @@ class PhotoPageHandler(RequestHandler):
 
         show_photo = self.get_query_argument('show', False) == 'on'
         if show_photo:
+            (src_width, src_height, src_quality, src_rotation) = \
+                    self.application.snap_rendition(img_width, img_height,
+                            float(self.get_query_argument(
+                                'quality', DEFAULT_QUALITY)),
+                            float(self.get_query_argument(
+                                'rotation', DEFAULT_ROTATION)))
             self.redirect(
                     ('%s/%s') % (
                          self.application._site_uri,
                          photo.get_rel_uri(
-                             img_width, img_height,
-                             float(self.get_query_argument(
-                                'rotation', DEFAULT_ROTATION)),
-                             float(self.get_query_argument(
-                                'quality', DEFAULT_QUALITY)),
+                             src_width, src_height,
+                             src_rotation, src_quality,
                              self.get_query_argument('format', None)
                          )
                      )
@@ -247,6 +731,7 @@ class PhotoPageHandler(RequestHandler):
                 page_query=self.request.query,
                 gallery=gallery,
                 photo=photo,
+                thumb_uri=self.application.thumbnail_uri,
                 width=img_width,
                 height=img_height,
                 settings={
@@ -265,19 +750,75 @@ class GalleryApp(Application):
     def __init__(self, root_dir, static_uri, static_path,
             site_name, site_uri,
             cache_subdir=CACHE_DIR_NAME,
-            num_proc=None, cache_expiry=300.0,
+            num_proc=None, pool_backend=BACKEND_PROCESS, pool_reserve=None,
+            pool_aging=DEFAULT_AGING, memory_budget=None,
+            fast_downscale_ratio=DEFAULT_FAST_DOWNSCALE_RATIO,
+            derive_renditions=False, rendition_pyramid=False,
+            memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE,
+            image_max_age=None, image_immutable=False,
+            delivery=DELIVERY_MEMORY, accel_prefix='',
+            cache_max_size=None, cache_max_files=None,
+            size_ladder=None, ladder_mode=LADDER_SERVE,
+            generate_renditions=warm.DEFAULT_RENDITIONS,
+            generate_concurrency=DEFAULT_JOB_CONCURRENCY,
+            max_queue=None, max_queue_wait=None,
+            client_miss_rate=None, client_miss_burst=None,
+            overload_fallback=False, task_id=None,
+            thumb_size=THUMB_SIZE, thumb_quality=THUMB_QUALITY,
+            contact_sheet=False, page_size=DEFAULT_PAGE_SIZE,
+            infinite_scroll=False, cache_expiry=300.0,
             cache_stat_expiry=1.0, **kwargs):
         self._static_uri = static_uri[:-1] if static_uri.endswith('/') \
                             else static_uri
         self._site_name = site_name
         self._site_uri = site_uri
+        self._image_max_age = image_max_age
+        self._image_immutable = image_immutable
+        self._delivery = delivery
+        self._accel_prefix = accel_prefix[:-1] \
+                if accel_prefix.endswith('/') else accel_prefix
+        self._size_ladder = size_ladder
+        self._ladder_mode = ladder_mode
+        self._overload_fallback = overload_fallback
+        self._task_id = task_id
+        self._contact_sheet = contact_sheet
+        self._page_size = page_size
+        self._infinite_scroll = infinite_scroll
+        # Compress metadata and pages for clients that accept it; images
+        # are sent as they are.
+        kwargs.setdefault('compress_response', True)
+        self._meta_cache = LRUCache(META_CACHE_SIZE)
+        if (max_queue is not None) or (max_queue_wait is not None) \
+                or client_miss_rate:
+            self._admission = AdmissionController(max_queue=max_queue,
+                    max_wait=max_queue_wait, client_rate=client_miss_rate,
+                    client_burst=client_miss_burst)
+        else:
+            self._admission = None
         self._collection = GalleryCollection(
                 root_dir=root_dir,
                 cache_subdir=cache_subdir,
-                num_proc=num_proc, cache_expiry=cache_expiry,
+                num_proc=num_proc, pool_backend=pool_backend,
+                pool_reserve=pool_reserve, pool_aging=pool_aging,
+                memory_budget=memory_budget,
+                fast_downscale_ratio=fast_downscale_ratio,
+                derive_renditions=derive_renditions,
+                rendition_pyramid=rendition_pyramid,
+                memory_cache_size=memory_cache_size,
+                cache_max_size=cache_max_size,
+                cache_max_files=cache_max_files,
+                cache_trim=not task_id,
+                thumb_size=thumb_size,
+                thumb_quality=thumb_quality,
+                cache_expiry=cache_expiry,
                 cache_stat_expiry=cache_stat_expiry)
+        self._jobs = JobManager(self._collection,
+                specs=generate_renditions, size_ladder=size_ladder,
+                concurrency=generate_concurrency)
         super(GalleryApp, self).__init__([
             (r"/.debug", DebugHandler),
+            (r"/.stats", StatsHandler),
+            (r"/sheet/([a-zA-Z0-9_\-]+)\.(jpg|json)", SheetHandler),
             (r"/([a-zA-Z0-9_\-]+)/([a-zA-Z0-9_\-]+\.[a-zA-Z]+)/(\d+|-)x(\d+|-)(?:@(\d*\.?\d*))?(?:/(\d*\.?\d*))?(?:/([a-z\-]+))?",
                 PhotoHandler),
             (r"/([a-zA-Z0-9_\-]+)/([a-zA-Z0-9_\-]+\.[a-zA-Z]+)/thumb.jpg",
@@ -286,6 +827,9 @@ class GalleryApp(Application):
                 PhotoPageHandler),
             (r"/meta/([a-zA-Z0-9_\-]+)/([a-zA-Z0-9_\-]+\.[a-zA-Z]+)",
                 PhotoMetaHandler),
+            (r"/meta/([a-zA-Z0-9_\-]+)/photos", PhotoBatchMetaHandler),
+            (r"/jobs/([a-zA-Z0-9_\-]+)", JobHandler),
+            (r"/jobs/([a-zA-Z0-9_\-]+)/events", JobEventsHandler),
             (r"/([a-zA-Z0-9_\-]+)/?", GalleryHandler),
             (r"/meta/([a-zA-Z0-9_\-]+)",
                 GalleryMetaHandler),
@@ -297,11 +841,105 @@ class GalleryApp(Application):
         static_path=static_path,
         **kwargs)
 
+    def snap_rendition(self, width, height, quality, rotation):
+        """
+        Return the canonical width, height, quality and rotation for a
+        requested rendition; unchanged unless a size ladder is configured.
+        """
+        if self._size_ladder is None:
+            return (width, height, quality, rotation)
+        return self._size_ladder.snap(width, height, quality, rotation)
+
+    def get_photo_meta(self, photo, width=None, height=None,
+            quality=DEFAULT_QUALITY, rotation=DEFAULT_ROTATION,
+            img_format=None):
+        """
+        Return the photo's metadata, with the size it is viewed at to fit
+        the given bounds and the URI of the rendition to show.
+        """
+        (img_width, img_height) = photo.get_fit_size(width, height)
+        (src_width, src_height, src_quality, src_rotation) = \
+                self.snap_rendition(img_width, img_height, quality, rotation)
+        return {
+            'photo': photo.meta,
+            'src': self._site_uri + '/' + photo.get_rel_uri(
+                src_width, src_height, src_rotation, src_quality,
+                img_format),
+            'user_size': {
+                'width': width,
+                'height': height,
+            },
+            'view_size': {
+                'width': img_width,
+                'height': img_height
+            }
+        }
+
+    def get_thumbnail(self, photo):
+        """
+        Return the rendition served as the photo's thumbnail.
+        """
+        (width, height, quality, rotation) = self.snap_rendition(
+                photo.thumbwidth, photo.thumbheight, photo.thumbquality, 0.0)
+        (width, height) = photo.get_fit_size(width, height)
+        return photo.get_rendition(width=width, height=height,
+                quality=quality, rotation=rotation, img_format=THUMB_FORMAT)
+
+    def get_thumbnails(self, photos):
+        """
+        Return the thumbnail renditions of the photos given.
+        """
+        return [self.get_thumbnail(photo) for photo in photos]
+
+    def get_sheet_info(self, gallery, sheet_map, offset=0, limit=None):
+        """
+        Return the URI and size of each contact sheet of the sheet map, and
+        which sheet each photo's thumbnail is on and where.  A sheet's URI
+        changes whenever the sheet does.
+        """
+        sheets = []
+        for (index, sheet) in enumerate(sheet_map['sheets']):
+            version = sha1(json.dumps(sheet['stamp']).encode('UTF-8'))\
+                    .hexdigest()[:16]
+            sheets.append({
+                'uri': '%s/sheet/%s.jpg?%s' % (self._site_uri,
+                    gallery.name, urlencode([('offset', offset)] \
+                        + ([('limit', limit)] if limit else []) \
+                        + [('sheet', index), ('v', version)])),
+                'version': version,
+                'width': sheet['width'],
+                'height': sheet['height'],
+            })
+        return {
+                'sheets': sheets,
+                'tiles': sheet_map['tiles'],
+        }
+
+    def thumbnail_uri(self, photo):
+        """
+        Return the canonical URI of the photo's thumbnail.
+        """
+        rendition = self.get_thumbnail(photo)
+        return '%s/%s' % (self._site_uri, photo.get_rel_uri(
+            rendition.width, rendition.height, rendition.rotation,
+            rendition.quality, THUMB_FORMAT))
+
+
+# Sub-commands, run as "tornado-gallery <command> ..."
+COMMANDS = {
+        'cache': diskcache.main,
+        'warm': warm.main,
+}
+
 
 def main(*args, **kwargs):
     """
     Console entry point.
     """
+    argv = list(args[0]) if args else sys.argv[1:]
+    if argv and (argv[0] in COMMANDS):
+        return COMMANDS[argv[0]](argv[1:])
+
     parser = argparse.ArgumentParser(
             description='Tornado Photo Gallery')
     parser.add_argument('--listen-address', dest='listen_address',
@@ -310,8 +948,125 @@ def main(*args, **kwargs):
             default=3000, help='Port number (TCP) to listen on.')
     parser.add_argument('--log-level', dest='log_level',
             default='INFO', help='Logging level')
+    parser.add_argument('--server-processes', dest='server_processes',
+            type=int, default=1,
+            help='Number of server processes sharing the listening socket; '\
+                    '0 starts one per CPU core.')
     parser.add_argument('--process-count', dest='process_count', type=int,
-            default=None, help='Size of image processing pool.')
+            default=None,
+            help='Size of image processing pool, shared out between the '\
+                    'server processes.')
+    parser.add_argument('--pool-backend', dest='pool_backend', type=str,
+            default=BACKEND_PROCESS, choices=BACKENDS,
+            help='Run image processing in worker processes or threads.')
+    parser.add_argument('--reserve-interactive', dest='reserve_interactive',
+            type=int, default=1,
+            help='Workers kept free for full-size image requests.')
+    parser.add_argument('--reserve-thumbnail', dest='reserve_thumbnail',
+            type=int, default=0,
+            help='Workers kept free for thumbnail and full-size requests.')
+    parser.add_argument('--pool-aging', dest='pool_aging', type=float,
+            default=DEFAULT_AGING,
+            help='Promote waiting jobs a priority class for each this many '\
+                    'seconds waited; 0 disables.')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int,
+            default=None,
+            help='Estimated memory (MiB) that concurrent resizes may use '\
+                    'between them, across all server processes.')
+    parser.add_argument('--fast-downscale-ratio', dest='fast_downscale_ratio',
+            type=float, default=DEFAULT_FAST_DOWNSCALE_RATIO,
+            help='Decode and reduce images at lower resolution when '\
+                    'shrinking by at least this ratio; 0 disables.')
+    parser.add_argument('--derive-renditions', dest='derive_renditions',
+            action='store_true', default=False,
+            help='Resize from larger cached renditions where possible.')
+    parser.add_argument('--rendition-pyramid', dest='rendition_pyramid',
+            action='store_true', default=False,
+            help='Cache power-of-two reductions of each photo to derive '\
+                    'renditions from (implies --derive-renditions).')
+    parser.add_argument('--memory-cache-size', dest='memory_cache_size',
+            type=int, default=DEFAULT_MEMORY_CACHE_SIZE // (1024 * 1024),
+            help='Memory budget (MiB) for recently served images; '\
+                    '0 disables.')
+    parser.add_argument('--image-max-age', dest='image_max_age',
+            type=int, default=None,
+            help='Cache-Control max-age (seconds) for resized images.')
+    parser.add_argument('--image-immutable', dest='image_immutable',
+            action='store_true', default=False,
+            help='Mark resized images as immutable in Cache-Control.')
+    parser.add_argument('--delivery', dest='delivery', type=str,
+            default=DELIVERY_MEMORY, choices=DELIVERY_MODES,
+            help='How resized images are sent: from memory, streamed '\
+                    'from the cache, or by the front-end server.')
+    parser.add_argument('--accel-prefix', dest='accel_prefix', type=str,
+            default='/cache',
+            help='Internal URI of the cache directory for X-Accel-Redirect.')
+    parser.add_argument('--cache-max-size', dest='cache_max_size', type=int,
+            default=None, help='Disk cache size budget (MiB).')
+    parser.add_argument('--cache-max-files', dest='cache_max_files',
+            type=int, default=None, help='Disk cache file count budget.')
+    parser.add_argument('--size-ladder', dest='size_ladder', type=str,
+            default=None,
+            help='Comma-separated widths/heights that requested sizes '\
+                    'are rounded up to.')
+    parser.add_argument('--quality-ladder', dest='quality_ladder', type=str,
+            default=None,
+            help='Comma-separated qualities that requested qualities '\
+                    'are rounded up to.')
+    parser.add_argument('--rotation-step', dest='rotation_step',
+            type=float, default=None,
+            help='Round requested rotations to a multiple of this (degrees).')
+    parser.add_argument('--ladder-mode', dest='ladder_mode', type=str,
+            default=LADDER_SERVE, choices=LADDER_MODES,
+            help='Redirect off-ladder requests to the canonical URL, or '\
+                    'serve the canonical rendition directly.')
+    parser.add_argument('--generate-rendition', dest='generate_renditions',
+            action='append', default=None,
+            help='Rendition rendered by gallery generation jobs, as '\
+                    'WIDTHxHEIGHT[@ROTATION][/QUALITY] or "thumb"; may be '\
+                    'repeated (default: %s)' % \
+                    ', '.join(warm.DEFAULT_RENDITIONS))
+    parser.add_argument('--thumb-size', dest='thumb_size', type=int,
+            default=THUMB_SIZE,
+            help='Size of thumbnails (pixels) along their longest edge.')
+    parser.add_argument('--thumb-quality', dest='thumb_quality',
+            type=float, default=THUMB_QUALITY,
+            help='JPEG quality of thumbnails.')
+    parser.add_argument('--contact-sheet', dest='contact_sheet',
+            action='store_true', default=False,
+            help='Draw gallery pages\' thumbnails from a single image.')
+    parser.add_argument('--page-size', dest='page_size', type=int,
+            default=DEFAULT_PAGE_SIZE,
+            help='Photos shown per gallery page; 0 shows them all.')
+    parser.add_argument('--infinite-scroll', dest='infinite_scroll',
+            action='store_true', default=False,
+            help='Load further gallery pages as the reader scrolls.')
+    parser.add_argument('--generate-concurrency',
+            dest='generate_concurrency', type=int,
+            default=DEFAULT_JOB_CONCURRENCY,
+            help='Renditions each generation job may have in flight.')
+    parser.add_argument('--max-queue', dest='max_queue', type=int,
+            default=None,
+            help='Refuse uncached images when this many are waiting to be '\
+                    'rendered ahead of them.')
+    parser.add_argument('--max-queue-wait', dest='max_queue_wait',
+            type=float, default=None,
+            help='Refuse uncached images when the estimated wait to render '\
+                    'them exceeds this (seconds).')
+    parser.add_argument('--client-miss-rate', dest='client_miss_rate',
+            type=float, default=None,
+            help='Uncached images each client may request per second.')
+    parser.add_argument('--client-miss-burst', dest='client_miss_burst',
+            type=int, default=None,
+            help='Uncached images each client may request in a burst.')
+    parser.add_argument('--overload-fallback', dest='overload_fallback',
+            action='store_true', default=False,
+            help='Send a smaller cached image, if there is one, rather '\
+                    'than refusing requests.')
+    parser.add_argument('--xheaders', dest='xheaders',
+            action='store_true', default=False,
+            help='Take client addresses from X-Real-IP/X-Forwarded-For '\
+                    'headers set by a front-end server.')
     parser.add_argument('--root-dir', dest='root_dir', type=str,
             help='Root directory containing photo galleries')
     parser.add_argument('--template-path', dest='template_path', type=str,
@@ -334,15 +1089,71 @@ def main(*args, **kwargs):
             format='%(asctime)s %(levelname)10s '\
                     '%(name)16s %(process)d/%(threadName)s: %(message)s')
 
+    size_ladder = None
+    if args.size_ladder or args.quality_ladder or args.rotation_step:
+        size_ladder = SizeLadder(
+                sizes=parse_steps(args.size_ladder),
+                qualities=parse_steps(args.quality_ladder, float),
+                rotation_step=args.rotation_step)
+
+    # Bind before forking so all the server processes share the socket.
+    # Each then starts its own share of the image processing pool.
+    sockets = bind_sockets(args.listen_port, address=args.listen_address)
+    num_proc = args.process_count or cpu_count()
+    memory_budget = args.memory_budget * 1024 * 1024 \
+            if args.memory_budget is not None else None
+    server_processes = args.server_processes or cpu_count()
+    task_id = None
+    if server_processes > 1:
+        task_id = fork_processes(server_processes)
+        num_proc = max(num_proc // server_processes, 1)
+        if memory_budget is not None:
+            memory_budget //= server_processes
+
     application = GalleryApp(root_dir=args.root_dir,
             static_uri=args.static_uri,
             static_path=args.static_path,
             site_name=args.site_name,
             site_uri=args.site_uri,
             template_path=args.template_path,
-            num_proc=args.process_count)
-    http_server = HTTPServer(application)
-    http_server.listen(port=args.listen_port, address=args.listen_address)
+            num_proc=num_proc,
+            pool_backend=args.pool_backend,
+            pool_reserve={
+                PRIORITY_INTERACTIVE: args.reserve_interactive,
+                PRIORITY_THUMBNAIL: args.reserve_thumbnail,
+            },
+            pool_aging=args.pool_aging,
+            memory_budget=memory_budget,
+            fast_downscale_ratio=args.fast_downscale_ratio,
+            derive_renditions=args.derive_renditions \
+                    or args.rendition_pyramid,
+            rendition_pyramid=args.rendition_pyramid,
+            memory_cache_size=args.memory_cache_size * 1024 * 1024,
+            image_max_age=args.image_max_age,
+            image_immutable=args.image_immutable,
+            delivery=args.delivery,
+            accel_prefix=args.accel_prefix,
+            cache_max_size=args.cache_max_size * 1024 * 1024 \
+                    if args.cache_max_size is not None else None,
+            cache_max_files=args.cache_max_files,
+            size_ladder=size_ladder,
+            ladder_mode=args.ladder_mode,
+            generate_renditions=args.generate_renditions \
+                    or warm.DEFAULT_RENDITIONS,
+            generate_concurrency=args.generate_concurrency,
+            max_queue=args.max_queue,
+            max_queue_wait=args.max_queue_wait,
+            client_miss_rate=args.client_miss_rate,
+            client_miss_burst=args.client_miss_burst,
+            overload_fallback=args.overload_fallback,
+            thumb_size=args.thumb_size,
+            thumb_quality=args.thumb_quality,
+            contact_sheet=args.contact_sheet,
+            page_size=args.page_size or None,
+            infinite_scroll=args.infinite_scroll,
+            task_id=task_id)
+    http_server = HTTPServer(application, xheaders=args.xheaders)
+    http_server.add_sockets(sockets)
     IOLoop.current().start()
 
 if __name__ == '__main__':
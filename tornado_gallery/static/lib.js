@@ -224,3 +224,69 @@ function toggleadj() {
 		document.getElementById('controls').deleteRow(2);
 	}
 }
+
+/**
+ * Append further pages of a gallery's thumbnails to a container as the
+ * reader nears the bottom of the page.
+ *
+ * @param container	Element the thumbnail links are appended to.
+ * @param options	An object describing the gallery:
+ * 	meta:		URI of the gallery's metadata
+ * 	offset:		Offset of the first photo not yet shown
+ * 	limit:		Photos to fetch per page
+ * 	total:		Number of photos in the gallery
+ * 	pageQuery:	Query string to append to photo page links
+ * 	thumbSize:	Size of thumbnails along their longest edge
+ */
+function infiniteScroll(container, options) {
+	var offset = options.offset;
+	var loading = false;
+
+	var addThumbnail = function (thumb) {
+		var xpad = (options.thumbSize / 2) + 10 - (thumb.width / 2);
+		var ypad = (options.thumbSize / 2) + 10 - (thumb.height / 2);
+		var link = document.createElement('a');
+		var img = document.createElement('img');
+
+		link.href = thumb.page_uri + '?' + options.pageQuery;
+		img.src = thumb.uri;
+		img.align = 'absmiddle';
+		img.width = thumb.width;
+		img.height = thumb.height;
+		img.alt = thumb.title;
+		img.style.padding = ypad + 'px ' + xpad + 'px';
+		link.appendChild(img);
+		container.appendChild(link);
+		container.appendChild(document.createTextNode(' '));
+	};
+
+	var loadMore = function () {
+		if (loading || (offset >= options.total))
+			return;
+
+		var remaining = document.documentElement.scrollHeight
+			- window.innerHeight - window.pageYOffset;
+		if (remaining > window.innerHeight)
+			return;
+
+		loading = true;
+		fetch(options.meta + '?thumbnails=1&offset=' + offset
+				+ '&limit=' + options.limit,
+				{expect: {200: true}}).then(function (xhr) {
+			var page = JSON.parse(xhr.responseText);
+			page.thumbnails.forEach(addThumbnail);
+			offset += page.thumbnails.length;
+			options.total = page.total;
+			loading = false;
+			if (page.thumbnails.length)
+				loadMore();
+		}).catch(function (err) {
+			/* Try again on the next scroll */
+			loading = false;
+		});
+	};
+
+	window.addEventListener('scroll', loadMore);
+	window.addEventListener('resize', loadMore);
+	loadMore();
+}
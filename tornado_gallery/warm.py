@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import re
+from time import time
+
+from multiprocessing import cpu_count
+
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Condition
+from tornado.queues import Queue
+
+from .gallery import GalleryCollection, CACHE_DIR_NAME
+from .ladder import SizeLadder, parse_steps
+from .pool import BACKEND_PROCESS, BACKENDS, PRIORITY_BATCH
+from .photo import THUMB_SIZE, THUMB_QUALITY, THUMB_FORMAT
+from .resizer import DEFAULT_FAST_DOWNSCALE_RATIO
+
+# Renditions warmed by default: thumbnails and the default photo view
+DEFAULT_RENDITIONS = ('thumb', '720x540/60')
+
+# Rendition specification: WIDTHxHEIGHT[@ROTATION][/QUALITY]
+_SPEC_RE = re.compile(r'^(\d+|-)x(\d+|-)(?:@(\d*\.?\d*))?(?:/(\d*\.?\d*))?$')
+
+# Specification of the thumbnail rendition
+THUMB_SPEC = 'thumb'
+
+
+def parse_spec(spec):
+    """
+    Parse a rendition specification into width, height, rotation and
+    quality, or return None for thumbnails.
+    """
+    if spec == THUMB_SPEC:
+        return None
+
+    match = _SPEC_RE.match(spec)
+    if match is None:
+        raise ValueError('Invalid rendition %r' % spec)
+
+    (width, height, rotation, quality) = match.groups()
+    return (int(width) if width != '-' else None,
+            int(height) if height != '-' else None,
+            float(rotation or 0.0),
+            float(quality or 60.0))
+
+
+class CacheWarmer(object):
+    """
+    Renders a set of renditions of every photo in the collection into the
+    cache, skipping those already cached.  Rendering is spread across the
+    collection's worker pool at batch priority; interrupted runs pick up
+    where they left off.
+    """
+
+    def __init__(self, collection, specs, galleries=None, size_ladder=None,
+            concurrency=1, report_interval=10.0, log=None):
+        if log is None:
+            log = logging.getLogger(self.__class__.__module__)
+
+        self._log = log
+        self._collection = collection
+        self._specs = [parse_spec(spec) for spec in specs]
+        self._galleries = galleries
+        self._size_ladder = size_ladder
+        self._concurrency = concurrency
+        self._report_interval = report_interval
+
+        self._total = 0
+        self._rendered = 0
+        self._skipped = 0
+        self._failed = 0
+        self._last = None
+        self._last_offset = None
+        self._start = None
+        self._finish = None
+        self._changed = Condition()
+
+    @property
+    def changed(self):
+        """
+        Condition notified whenever progress is made.
+        """
+        return self._changed
+
+    @property
+    def progress(self):
+        return {
+                'total': self._total,
+                'done': self._rendered + self._skipped + self._failed,
+                'rendered': self._rendered,
+                'skipped': self._skipped,
+                'failed': self._failed,
+                'last': self._last,
+                'last_offset': self._last_offset,
+                'start': self._start,
+                'finish': self._finish,
+        }
+
+    def _snap(self, width, height, quality, rotation):
+        if self._size_ladder is None:
+            return (width, height, quality, rotation)
+        return self._size_ladder.snap(width, height, quality, rotation)
+
+    def _get_renditions(self, photo):
+        """
+        Return the renditions of the photo that the front-end would request
+        for each specification.
+        """
+        renditions = []
+        for spec in self._specs:
+            if spec is None:
+                (width, height, quality, rotation) = self._snap(
+                        photo.thumbwidth, photo.thumbheight,
+                        photo.thumbquality, 0.0)
+                img_format = THUMB_FORMAT
+            else:
+                (width, height, rotation, quality) = spec
+                (width, height) = photo.get_fit_size(
+                        min(photo.width, width) if width else None,
+                        min(photo.height, height) if height else None)
+                (width, height, quality, rotation) = self._snap(
+                        width, height, quality, rotation)
+                img_format = None
+
+            (width, height) = photo.get_fit_size(width, height)
+            renditions.append(photo.get_rendition(width=width,
+                height=height, quality=quality, rotation=rotation,
+                img_format=img_format))
+        return renditions
+
+    def _report(self):
+        done = self._rendered + self._skipped + self._failed
+        elapsed = time() - self._start
+        rate = self._rendered / elapsed if elapsed > 0 else 0.0
+        self._log.info('%d/%d renditions: %d rendered, %d skipped, '\
+                '%d failed; %.1f renditions/sec',
+                done, self._total, self._rendered, self._skipped,
+                self._failed, rate)
+
+    @coroutine
+    def _worker(self, queue):
+        while True:
+            (photo, offset, rendition) = yield queue.get()
+            try:
+                if photo is None:
+                    return
+
+                if photo.get_cache_stat(rendition) is not None:
+                    self._skipped += 1
+                else:
+                    try:
+                        yield photo.get_rendition_path(rendition,
+                                priority=PRIORITY_BATCH)
+                        self._rendered += 1
+                    except:
+                        self._log.exception('Failed to render %s',
+                                rendition.cache_path)
+                        self._failed += 1
+                self._last = photo.name
+                self._last_offset = offset
+                self._changed.notify_all()
+            finally:
+                queue.task_done()
+
+    @coroutine
+    def run(self):
+        """
+        Warm the cache, returning the number of renditions that failed.
+        """
+        self._start = time()
+        galleries = self._galleries or list(self._collection)
+
+        # Index the photos first; this also tells us how much there is to do
+        photos = []
+        for gallery_name in galleries:
+            gallery = self._collection[gallery_name]
+            yield gallery.load_properties(priority=PRIORITY_BATCH)
+            photos.extend((gallery_name, offset, photo)
+                    for (offset, photo) in enumerate(gallery.values()))
+        self._total = len(photos) * len(self._specs)
+        self._changed.notify_all()
+        self._log.info('Warming %d renditions of %d photos in %d galleries',
+                self._total, len(photos), len(galleries))
+
+        concurrency = self._concurrency
+        queue = Queue(maxsize=concurrency)
+        workers = [self._worker(queue) for n in range(concurrency)]
+
+        reporter = PeriodicCallback(self._report,
+                self._report_interval * 1000.0)
+        reporter.start()
+        try:
+            for (gallery_name, offset, photo) in photos:
+                try:
+                    renditions = self._get_renditions(photo)
+                except:
+                    self._log.exception('Failed to examine %s/%s',
+                            gallery_name, photo.name)
+                    self._failed += len(self._specs)
+                    continue
+
+                for rendition in renditions:
+                    yield queue.put((photo, offset, rendition))
+
+            for worker in workers:
+                yield queue.put((None, None, None))
+            yield workers
+        finally:
+            reporter.stop()
+            self._finish = time()
+            self._changed.notify_all()
+
+        self._report()
+        raise Return(self._failed)
+
+
+def main(*args, **kwargs):
+    """
+    Render renditions of every photo into the cache ahead of time.
+    """
+    parser = argparse.ArgumentParser(prog='tornado-gallery warm',
+            description='Tornado Photo Gallery cache warm-up')
+    parser.add_argument('galleries', nargs='*',
+            help='Galleries to warm (default: all)')
+    parser.add_argument('--log-level', dest='log_level',
+            default='INFO', help='Logging level')
+    parser.add_argument('--root-dir', dest='root_dir', type=str,
+            required=True, help='Root directory containing photo galleries')
+    parser.add_argument('--cache-subdir', dest='cache_subdir', type=str,
+            default=CACHE_DIR_NAME, help='Cache directory within the root')
+    parser.add_argument('--rendition', dest='renditions', action='append',
+            default=None,
+            help='Rendition to produce, as WIDTHxHEIGHT[@ROTATION]'\
+                    '[/QUALITY] or "thumb"; may be repeated '\
+                    '(default: %s)' % ', '.join(DEFAULT_RENDITIONS))
+    parser.add_argument('--process-count', dest='process_count', type=int,
+            default=None, help='Size of image processing pool.')
+    parser.add_argument('--pool-backend', dest='pool_backend', type=str,
+            default=BACKEND_PROCESS, choices=BACKENDS,
+            help='Run image processing in worker processes or threads.')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int,
+            default=None,
+            help='Estimated memory (MiB) that concurrent resizes may use '\
+                    'between them.')
+    parser.add_argument('--fast-downscale-ratio', dest='fast_downscale_ratio',
+            type=float, default=DEFAULT_FAST_DOWNSCALE_RATIO,
+            help='Decode and reduce images at lower resolution when '\
+                    'shrinking by at least this ratio; 0 disables.')
+    parser.add_argument('--derive-renditions', dest='derive_renditions',
+            action='store_true', default=False,
+            help='Resize from larger cached renditions where possible.')
+    parser.add_argument('--rendition-pyramid', dest='rendition_pyramid',
+            action='store_true', default=False,
+            help='Cache power-of-two reductions of each photo to derive '\
+                    'renditions from (implies --derive-renditions).')
+    parser.add_argument('--size-ladder', dest='size_ladder', type=str,
+            default=None, help='Size ladder, as given to the server.')
+    parser.add_argument('--quality-ladder', dest='quality_ladder', type=str,
+            default=None, help='Quality ladder, as given to the server.')
+    parser.add_argument('--rotation-step', dest='rotation_step',
+            type=float, default=None,
+            help='Rotation step, as given to the server.')
+    parser.add_argument('--thumb-size', dest='thumb_size', type=int,
+            default=THUMB_SIZE, help='Thumbnail size, as given to the server.')
+    parser.add_argument('--thumb-quality', dest='thumb_quality',
+            type=float, default=THUMB_QUALITY,
+            help='Thumbnail quality, as given to the server.')
+    parser.add_argument('--report-interval', dest='report_interval',
+            type=float, default=10.0,
+            help='How often to report progress (seconds).')
+
+    args = parser.parse_args(*args, **kwargs)
+
+    logging.basicConfig(level=args.log_level,
+            format='%(asctime)s %(levelname)10s '\
+                    '%(name)16s %(process)d/%(threadName)s: %(message)s')
+
+    size_ladder = None
+    if args.size_ladder or args.quality_ladder or args.rotation_step:
+        size_ladder = SizeLadder(
+                sizes=parse_steps(args.size_ladder),
+                qualities=parse_steps(args.quality_ladder, float),
+                rotation_step=args.rotation_step)
+
+    num_proc = args.process_count or cpu_count()
+    collection = GalleryCollection(root_dir=args.root_dir,
+            cache_subdir=args.cache_subdir,
+            num_proc=num_proc,
+            pool_backend=args.pool_backend,
+            pool_reserve={},
+            memory_budget=args.memory_budget * 1024 * 1024 \
+                    if args.memory_budget is not None else None,
+            fast_downscale_ratio=args.fast_downscale_ratio,
+            derive_renditions=args.derive_renditions \
+                    or args.rendition_pyramid,
+            rendition_pyramid=args.rendition_pyramid,
+            memory_cache_size=0,
+            cache_trim=False,
+            cache_index=True,
+            thumb_size=args.thumb_size,
+            thumb_quality=args.thumb_quality)
+
+    # Keep the pool's queue topped up without walking ahead too far.
+    warmer = CacheWarmer(collection,
+            specs=args.renditions or DEFAULT_RENDITIONS,
+            galleries=args.galleries,
+            size_ladder=size_ladder,
+            concurrency=2 * num_proc,
+            report_interval=args.report_interval)
+    failed = IOLoop.current().run_sync(warmer.run)
+
+    # Let the server's disk cache manager know what we wrote.
+    IOLoop.current().run_sync(collection.flush_cache_index)
+    return 1 if failed else 0